@@ -0,0 +1,213 @@
+"""TENSORFLOW-FREE TFRECORD FORMAT
+Record framing (length + masked CRC32C) and the tf.train.Example protobuf
+encoding, so writing and reading datasets does not need to import TensorFlow.
+"""
+
+import struct
+
+try:
+    # Optional C implementation, much faster than the table below
+    from crc32c import crc32c as _fastCrc32c
+except ImportError:
+    _fastCrc32c = None
+
+# Feature kinds of tf.train.Feature, with their protobuf field numbers
+BYTES_LIST = 1
+FLOAT_LIST = 2
+INT64_LIST = 3
+
+_CRC_TABLE = []
+for _byte in range(256):
+    _crc = _byte
+    for _ in range(8):
+        _crc = (_crc >> 1) ^ 0x82F63B78 if _crc & 1 else _crc >> 1
+    _CRC_TABLE.append(_crc)
+
+def crc32c(data):
+    if _fastCrc32c is not None:
+        return _fastCrc32c(data)
+    crc   = 0xFFFFFFFF
+    table = _CRC_TABLE
+    for byte in data:
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+def maskedCrc32c(data):
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+class RecordWriter:
+    # Same interface as tf.io.TFRecordWriter
+    def __init__(self, filename):
+        self._file = open(filename, 'wb')
+
+    def write(self, record):
+        header = struct.pack('<Q', len(record))
+        self._file.write(header)
+        self._file.write(struct.pack('<I', maskedCrc32c(header)))
+        self._file.write(record)
+        self._file.write(struct.pack('<I', maskedCrc32c(record)))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def readRecord(file, checkCrc=True):
+    # Returns the next record of an open file, or None at the end of the file
+    header = file.read(12)
+    if len(header) == 0:
+        return None
+    if len(header) < 12:
+        raise IOError("Truncated TFRecord header")
+    length, lengthCrc = struct.unpack('<QI', header)
+    if checkCrc and maskedCrc32c(header[:8]) != lengthCrc:
+        raise IOError("Corrupted TFRecord length")
+
+    record = file.read(length)
+    footer = file.read(4)
+    if len(record) < length or len(footer) < 4:
+        raise IOError("Truncated TFRecord data")
+    if checkCrc and maskedCrc32c(record) != struct.unpack('<I', footer)[0]:
+        raise IOError("Corrupted TFRecord data")
+    return record
+
+def iterRecords(filename, checkCrc=True):
+    with open(filename, 'rb') as file:
+        while True:
+            record = readRecord(file, checkCrc)
+            if record is None:
+                return
+            yield record
+
+
+def _varint(value):
+    # Negative int64 values are encoded as their 64-bit two's complement
+    value &= 0xFFFFFFFFFFFFFFFF
+    out   = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def _lengthDelimited(fieldNumber, payload):
+    return _varint((fieldNumber << 3) | 2) + _varint(len(payload)) + payload
+
+def encodeFeature(kind, values):
+    if kind == BYTES_LIST:
+        payload = b''.join(_lengthDelimited(1, bytes(value)) for value in values)
+    elif kind == FLOAT_LIST:
+        payload = _lengthDelimited(1, struct.pack('<%df' % len(values), *values)) if len(values) else b''
+    elif kind == INT64_LIST:
+        payload = _lengthDelimited(1, b''.join(_varint(int(value)) for value in values)) if len(values) else b''
+    else:
+        raise ValueError("Unknown feature kind %s" % str(kind))
+    return _lengthDelimited(kind, payload)
+
+def encodeExample(features):
+    # features: {name: (kind, values)}
+    entries = b''.join(_lengthDelimited(1, _lengthDelimited(1, name.encode('utf-8')) +
+                                           _lengthDelimited(2, encodeFeature(kind, values)))
+                       for name, (kind, values) in features.items())
+    return _lengthDelimited(1, entries)
+
+
+def _readVarint(data, pos):
+    result = 0
+    shift  = 0
+    while True:
+        byte    = data[pos]
+        pos    += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift  += 7
+
+def _iterFields(data):
+    # Yields (fieldNumber, wireType, value) of a protobuf message
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = _readVarint(data, pos)
+        fieldNumber, wireType = key >> 3, key & 7
+        if wireType == 0:
+            value, pos = _readVarint(data, pos)
+        elif wireType == 1:
+            value, pos = data[pos:pos + 8], pos + 8
+        elif wireType == 2:
+            length, pos = _readVarint(data, pos)
+            value, pos  = data[pos:pos + length], pos + length
+        elif wireType == 5:
+            value, pos = data[pos:pos + 4], pos + 4
+        else:
+            raise ValueError("Unsupported protobuf wire type %d" % wireType)
+        yield fieldNumber, wireType, value
+
+def _toInt64(value):
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def decodeFeature(data):
+    # Returns (kind, values), packed and unpacked repeated fields are both accepted
+    for kind, _, listData in _iterFields(data):
+        values = []
+        for _, wireType, value in _iterFields(listData):
+            if kind == BYTES_LIST:
+                values.append(bytes(value))
+            elif kind == FLOAT_LIST:
+                values.extend(struct.unpack('<%df' % (len(value) // 4), value))
+            elif kind == INT64_LIST:
+                if wireType == 0:
+                    values.append(_toInt64(value))
+                else:
+                    pos = 0
+                    while pos < len(value):
+                        number, pos = _readVarint(value, pos)
+                        values.append(_toInt64(number))
+        return kind, values
+    return None, []
+
+def decodeExample(data, skip=()):
+    # Returns {name: (kind, values)}, features named in skip are left undecoded
+    features = {}
+    for fieldNumber, _, featuresData in _iterFields(memoryview(data)):
+        if fieldNumber != 1:
+            continue
+        for _, _, entry in _iterFields(featuresData):
+            name, featureData = None, b''
+            for entryField, _, value in _iterFields(entry):
+                if entryField == 1:
+                    name = bytes(value).decode('utf-8')
+                elif entryField == 2:
+                    featureData = value
+            if name in skip:
+                continue
+            features[name] = decodeFeature(featureData)
+    return features
+
+
+class Example:
+    # Drop-in for tf.train.Example as far as the writers are concerned
+    def __init__(self, features):
+        self.features = features
+
+    def SerializeToString(self):
+        return encodeExample(self.features)
+
+    @classmethod
+    def FromString(cls, data):
+        return cls(decodeExample(data))
+
+    def toTensorflow(self, tf):
+        feature = {}
+        for name, (kind, values) in self.features.items():
+            if kind == BYTES_LIST:
+                feature[name] = tf.train.Feature(bytes_list=tf.train.BytesList(value=values))
+            elif kind == FLOAT_LIST:
+                feature[name] = tf.train.Feature(float_list=tf.train.FloatList(value=values))
+            else:
+                feature[name] = tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+        return tf.train.Example(features=tf.train.Features(feature=feature))
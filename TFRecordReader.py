@@ -3,60 +3,141 @@ AND REGENERATING DATA
 """
 
 import io
-import tensorflow as tf
 import os
 from PIL import Image
 from MkDataSetStructure import MkDataSetStructure
 from Tagger import Tagger
+import TFRecordFormat
+from TFRecordWriter import BACKENDS, importTensorflow
 
 # Reading an existent tfrecord and extract information
 class TFRecordReader:
-    def __init__(self, tfrecordsFilename):
-        self._readerIterator  = tf.python_io.tf_record_iterator(path=tfrecordsFilename)
-
-    def readTFRecord(self):
-        dataBuffer = []
-        for stringRecord in self._readerIterator:
-            tempData = {}
-            example = tf.train.Example()
+    def __init__(self, tfrecordsFilename, backend='lite', indexFilename=None):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown TFRecord backend %s" % str(backend))
+        self.backend       = backend
+        self.filename      = tfrecordsFilename
+        self.indexFilename = indexFilename or tfrecordsFilename + '.index'
+        self.offsets       = None  # Byte offset of every record, loaded on first random access
+        self.sourceIDs     = None  # image/source_id -> record position
+        self._tf           = importTensorflow() if backend == 'tensorflow' else None
+
+    def parseExample(self, stringRecord, withImage=True):
+        # Returns {feature name: list of values} for both backends
+        if self.backend == 'tensorflow':
+            example = self._tf.train.Example()
             example.ParseFromString(stringRecord)
+            return {name: list(getattr(feature, feature.WhichOneof('kind')).value) if feature.WhichOneof('kind') else []
+                    for name, feature in example.features.feature.items()}
+        skip = () if withImage else ('image/encoded',)
+        return {name: values for name, (_, values) in TFRecordFormat.decodeExample(stringRecord, skip=skip).items()}
+
+    def recordToData(self, stringRecord, withImage=True):
+        tempData = {}
+        features = self.parseExample(stringRecord, withImage)
+
+        height          = int(features['image/height'][0])
+        width           = int(features['image/width'][0])
+        filename        = features['image/filename'][0]
+        sourceID        = features['image/source_id'][0]
+        imgEncoded      = features['image/encoded'][0] if withImage else None
+        imageFormat     = features['image/format'][0]
+        xMins           = features['image/object/bbox/xmin']
+        xMaxs           = features['image/object/bbox/xmax']
+        yMins           = features['image/object/bbox/ymin']
+        yMaxs           = features['image/object/bbox/ymax']
+        classesText     = features['image/object/class/text']
+        classesID       = features['image/object/class/label']
+
+        tempData["height"]      = height
+        tempData["width"]       = width
+        tempData["filename"]    = filename.decode("utf-8")
+        tempData["sourceID"]    = sourceID.decode("utf-8")
+        tempData["imgEncoded"]  = imgEncoded
+        tempData["imageFormat"] = imageFormat
+        tempData["xMins"]       = [(i * width) for i in xMins]
+        tempData["xMaxs"]       = [(i * width) for i in xMaxs]
+        tempData["yMins"]       = [(i * height) for i in yMins]
+        tempData["yMaxs"]       = [(i * height) for i in yMaxs]
+        tempData["classesText"] = classesText
+        tempData["classesID"]   = classesID
+        return tempData
+
+    def iterTFRecord(self, withImage=True):
+        # Yields one record at a time, images stay encoded until decodeImage is called
+        for stringRecord in TFRecordFormat.iterRecords(self.filename):
+            yield self.recordToData(stringRecord, withImage)
 
-            height          = int(example.features.feature['image/height'].int64_list.value[0])
-            width           = int(example.features.feature['image/width'].int64_list.value[0])
-            filename        = example.features.feature['image/filename'].bytes_list.value[0]
-            sourceID        = example.features.feature['image/source_id'].bytes_list.value[0]
-            imgEncoded      = example.features.feature['image/encoded'].bytes_list.value[0]
-            imageFormat     = example.features.feature['image/format'].bytes_list.value[0]
-            xMins           = example.features.feature['image/object/bbox/xmin'].float_list.value
-            xMaxs           = example.features.feature['image/object/bbox/xmax'].float_list.value
-            yMins           = example.features.feature['image/object/bbox/ymin'].float_list.value
-            yMaxs           = example.features.feature['image/object/bbox/ymax'].float_list.value
-            classesText     = example.features.feature['image/object/class/text'].bytes_list.value
-            classesID       = example.features.feature['image/object/class/label'].int64_list.value
-
-            tempData["height"]      = height
-            tempData["width"]       = width
-            tempData["filename"]    = filename.decode("utf-8")
-            tempData["sourceID"]    = sourceID.decode("utf-8")
-            tempData["imgEncoded"]  = imgEncoded
-            tempData["imageFormat"] = imageFormat
-            tempData["xMins"]       = [(i * width) for i in xMins]
-            tempData["xMaxs"]       = [(i * width) for i in xMaxs]
-            tempData["yMins"]       = [(i * height) for i in yMins]
-            tempData["yMaxs"]       = [(i * height) for i in yMaxs]
-            tempData["classesText"] = classesText
-            tempData["classesID"]   = classesID
-
-            dataBuffer.append(tempData)
-        return dataBuffer
+    def readTFRecord(self):
+        return list(self.iterTFRecord())
+
+    @staticmethod
+    def decodeImage(data):
+        return Image.open(io.BytesIO(data["imgEncoded"]))
+
+    def buildIndex(self):
+        # Sidecar index, one "offset sourceID" line per record
+        offsets   = []
+        sourceIDs = []
+        with open(self.filename, 'rb') as file:
+            while True:
+                offset       = file.tell()
+                stringRecord = TFRecordFormat.readRecord(file, checkCrc=False)
+                if stringRecord is None:
+                    break
+                features = TFRecordFormat.decodeExample(stringRecord, skip=('image/encoded',))
+                offsets.append(offset)
+                sourceIDs.append(features['image/source_id'][1][0].decode('utf-8'))
+
+        with open(self.indexFilename, 'w') as indexFile:
+            for offset, sourceID in zip(offsets, sourceIDs):
+                indexFile.write("%d %s\n" % (offset, sourceID))
+        self.setIndex(offsets, sourceIDs)
+
+    def loadIndex(self):
+        # A missing or outdated sidecar index is rebuilt
+        if not os.path.isfile(self.indexFilename) or os.path.getmtime(self.indexFilename) < os.path.getmtime(self.filename):
+            self.buildIndex()
+            return
+
+        offsets   = []
+        sourceIDs = []
+        with open(self.indexFilename) as indexFile:
+            for line in indexFile:
+                offset, sourceID = line.rstrip("\n").split(" ", 1)
+                offsets.append(int(offset))
+                sourceIDs.append(sourceID)
+        self.setIndex(offsets, sourceIDs)
+
+    def setIndex(self, offsets, sourceIDs):
+        self.offsets   = offsets
+        self.sourceIDs = {sourceID: position for position, sourceID in enumerate(sourceIDs)}
+
+    def __len__(self):
+        if self.offsets is None:
+            self.loadIndex()
+        return len(self.offsets)
+
+    def __getitem__(self, position):
+        if self.offsets is None:
+            self.loadIndex()
+        with open(self.filename, 'rb') as file:
+            file.seek(self.offsets[position])
+            return self.recordToData(TFRecordFormat.readRecord(file))
+
+    def findBySourceID(self, sourceID):
+        if self.sourceIDs is None:
+            self.loadIndex()
+        if sourceID not in self.sourceIDs:
+            return None
+        return self[self.sourceIDs[sourceID]]
 
     # regenerate original image file from tfrecord data
     def regenerateImages(self, outputPath):
         if not os.path.exists(outputPath):
             os.mkdir(outputPath)
 
-        dataBuffer = self.readTFRecord()
-        for data in dataBuffer:
+        for data in self.iterTFRecord():
             rawImageData            = data["imgEncoded"]
             height                  = data["height"]
             width                   = data["width"]
@@ -70,10 +151,9 @@ class TFRecordReader:
 
     def tfRecordToCaffe(self, datasetName, outputPath, nameAsGroundTruth=False):
         MkDataSetStructure(os.path.join(outputPath,datasetName))
-        fileManager = Tagger(os.path.join(outputPath, datasetName))
+        fileManager = Tagger(os.path.join(outputPath, datasetName), buffered=True)
 
-        dataBuffer = self.readTFRecord()
-        for data in dataBuffer:
+        for data in self.iterTFRecord():
             if nameAsGroundTruth: imageName = data['filename']
             else: imageName = data["sourceID"]
 
@@ -91,6 +171,7 @@ class TFRecordReader:
                                                                   data["xMaxs"], data["yMaxs"],
                                                                   data["classesText"], data["classesID"]):
                 fileManager.AppendAnnotation((xMin, yMin), (xMax,yMax), imageName, classText.decode('utf-8') + " " + str(classID))
+        fileManager.Close()
 
 if __name__ == "__main__":
     outputPath = '/home/junior/Documents/NN/datasets'
@@ -1,4 +1,13 @@
-import tensorflow as tf
+import os
+import TFRecordFormat
+from TFRecordFormat import BYTES_LIST, FLOAT_LIST, INT64_LIST
+
+# 'lite' frames and encodes the records without TensorFlow, 'tensorflow' uses tf.io
+BACKENDS = ('lite', 'tensorflow')
+
+def importTensorflow():
+    import tensorflow as tf
+    return tf
 
 class TFExample:
     def __init__(self):
@@ -17,11 +26,19 @@ class TFExample:
         self.tilesID            = []    # List of tiles from certain image
 
 class TFRecordWriter:
-    def __init__(self, tfrecordsFilename):
-        self._writer  = tf.python_io.TFRecordWriter(tfrecordsFilename)
+    def __init__(self, tfrecordsFilename, backend='lite'):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown TFRecord backend %s" % str(backend))
+        self.backend  = backend
+        self._tf      = None
+        if backend == 'tensorflow':
+            self._tf      = importTensorflow()
+            self._writer  = self._tf.io.TFRecordWriter(tfrecordsFilename)
+        else:
+            self._writer  = TFRecordFormat.RecordWriter(tfrecordsFilename)
 
     def createTfExample(self, tfExample):
-        tf_example = tf.train.Example(features=tf.train.Features(feature={
+        tf_example = TFRecordFormat.Example({
             'image/height':             self.int64_feature(tfExample.height),
             'image/width':              self.int64_feature(tfExample.width),
             'image/filename':           self.bytes_feature(tfExample.filename),
@@ -34,7 +51,9 @@ class TFRecordWriter:
             'image/object/bbox/ymax':   self.float_list_feature(tfExample.yMaxs),
             'image/object/class/text':  self.bytes_list_feature(tfExample.classesText),
             'image/object/class/label': self.int64_list_feature(tfExample.classes)
-        }))
+        })
+        if self.backend == 'tensorflow':
+            return tf_example.toTensorflow(self._tf)
         return tf_example
 
     def closeTfStream(self):
@@ -43,22 +62,53 @@ class TFRecordWriter:
     def appendExampleToTfStream(self, parsedTfExample):
         self._writer.write(parsedTfExample.SerializeToString())
 
+    def appendSerializedExampleToTfStream(self, serializedTfExample):
+        self._writer.write(serializedTfExample)
+
     @staticmethod
     def int64_feature(value):
-        return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+        return (INT64_LIST, [value])
 
     @staticmethod
     def int64_list_feature(value):
-        return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
+        return (INT64_LIST, list(value))
 
     @staticmethod
     def bytes_feature(value):
-        return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+        return (BYTES_LIST, [value])
 
     @staticmethod
     def bytes_list_feature(value):
-        return tf.train.Feature(bytes_list=tf.train.BytesList(value=value))
+        return (BYTES_LIST, list(value))
 
     @staticmethod
     def float_list_feature(value):
-        return tf.train.Feature(float_list=tf.train.FloatList(value=value))
\ No newline at end of file
+        return (FLOAT_LIST, list(value))
+
+
+# Spreads the records over name-00000-of-00064.tfrecord style shards, each one with its own writer
+class ShardedTFRecordWriter(TFRecordWriter):
+    def __init__(self, tfrecordsFilename, numShards, backend='lite'):
+        self.backend    = backend
+        self.filenames  = self.shardFilenames(tfrecordsFilename, numShards)
+        self._writers   = [TFRecordWriter(filename, backend=backend) for filename in self.filenames]
+        self._tf        = self._writers[0]._tf
+        self._nextShard = 0
+
+    @staticmethod
+    def shardFilenames(tfrecordsFilename, numShards):
+        name, extension = os.path.splitext(tfrecordsFilename)
+        extension       = extension or ".tfrecord"
+        return ["%s-%05d-of-%05d%s" % (name, shard, numShards, extension) for shard in range(numShards)]
+
+    def closeTfStream(self):
+        for writer in self._writers:
+            writer.closeTfStream()
+
+    def appendExampleToTfStream(self, parsedTfExample):
+        self.appendSerializedExampleToTfStream(parsedTfExample.SerializeToString())
+
+    def appendSerializedExampleToTfStream(self, serializedTfExample):
+        # Round robin keeps the shards balanced
+        self._writers[self._nextShard].appendSerializedExampleToTfStream(serializedTfExample)
+        self._nextShard = (self._nextShard + 1) % len(self._writers)
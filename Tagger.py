@@ -5,7 +5,7 @@ from os import listdir
 from os.path import isfile
 
 class Tagger:
-    def __init__(self, dataSet_dir):
+    def __init__(self, dataSet_dir, buffered=False, flushEvery=1000):
 
         #Setting directories
         self._tagDir = os.path.join(dataSet_dir, "Annotations")
@@ -14,9 +14,21 @@ class Tagger:
         self._imageLogDir = os.path.join(dataSet_dir, "ImageLogs")
         self._imagesDir = os.path.join(dataSet_dir, "Images")
 
+        # Buffered mode: image sets are indexed in memory and writes are flushed in bulk
+        self._buffered = buffered
+        self._flushEvery = flushEvery
+        self._setIndex = {}           # set file -> entries already in it
+        self._pendingSetLines = {}    # set file -> lines waiting to be written
+        self._pendingAnnotations = {} # annotation file -> lines waiting to be written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.Close()
+
     def AppendAnnotation(self, leftBottom, rightTop, imgName, cls):
         tagFile = os.path.join(self._tagDir, '%s.txt' % (imgName))
-        logData = open(tagFile, 'a+')
 
         xMin = leftBottom[0]
         xMax = rightTop[0]
@@ -38,11 +50,22 @@ class Tagger:
 
 
 
-        logData.write(str(int(xMin)) + " " + str(int(yMin)) + " " + str(int(xMax)) + " " + str(int(yMax)) + " " + str(cls) + "\n")
+        line = str(int(xMin)) + " " + str(int(yMin)) + " " + str(int(xMax)) + " " + str(int(yMax)) + " " + str(cls) + "\n"
+        if self._buffered:
+            self._pendingAnnotations.setdefault(tagFile, []).append(line)
+            if len(self._pendingAnnotations) > self._flushEvery:
+                self.FlushAnnotations()
+            return
+
+        logData = open(tagFile, 'a+')
+        logData.write(line)
         logData.close()
 
     def AppendTrainingImg(self, imgName):
         trainFile = os.path.join(self._imageSetsDir, "train.txt")
+        if self._buffered:
+            self.AppendToSet(trainFile, str(imgName) + "\n")
+            return
         stringExists = self.CheckExistence(trainFile, imgName)
 
         if not stringExists:
@@ -62,6 +85,9 @@ class Tagger:
 
     def AppendClassName(self, className):
         classesFile = os.path.join(self._imageSetsDir, "classes.txt")
+        if self._buffered:
+            self.AppendToSet(classesFile, str(className))
+            return
         stringExists = self.CheckExistence(classesFile, className)
 
         if not stringExists:
@@ -70,6 +96,40 @@ class Tagger:
             classesData.close()
             classesData.close()
 
+    def AppendToSet(self, setFile, line):
+        # Exact entry lookup in the in-memory index instead of rereading the file
+        if setFile not in self._setIndex:
+            self._setIndex[setFile] = set()
+            if os.path.isfile(setFile):
+                with open(setFile) as setData:
+                    self._setIndex[setFile].update(entry.rstrip("\n") for entry in setData)
+
+        entry = line.rstrip("\n")
+        if entry in self._setIndex[setFile]:
+            return
+        self._setIndex[setFile].add(entry)
+        self._pendingSetLines.setdefault(setFile, []).append(line)
+
+    def FlushAnnotations(self):
+        for tagFile, lines in self._pendingAnnotations.items():
+            with open(tagFile, 'a+') as logData:
+                logData.writelines(lines)
+        self._pendingAnnotations = {}
+
+    def Flush(self):
+        self.FlushAnnotations()
+        for setFile, lines in self._pendingSetLines.items():
+            with open(setFile, 'a+') as setData:
+                setData.writelines(lines)
+        self._pendingSetLines = {}
+
+    def ForgetSet(self, setFile):
+        self._setIndex.pop(setFile, None)
+        self._pendingSetLines.pop(setFile, None)
+
+    def Close(self):
+        self.Flush()
+
     def AppendImgLog(self, imgName, log):
         logFile = os.path.join(self._imageLogDir, '%s.txt' % (imgName))
         logData = open(logFile, 'w+')
@@ -151,16 +211,19 @@ class Tagger:
 
     def EraseClassesFile(self):
         fileName = os.path.join(self._imageSetsDir, "classes.txt")
+        self.ForgetSet(fileName)
         if os.path.exists(fileName):
             open(fileName, 'w').close()
 
     def EraseAnnotations(self, imgName):
         fileName = os.path.join(self._tagDir, '%s.txt' % (imgName))
+        self._pendingAnnotations.pop(fileName, None)
         if os.path.exists(fileName):
             open(fileName, 'w').close()
 
     def EraseTrainingFile(self):
         fileName = os.path.join(self._imageSetsDir, "train.txt")
+        self.ForgetSet(fileName)
         if os.path.exists(fileName):
             open(fileName, 'w').close()
 
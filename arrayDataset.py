@@ -0,0 +1,131 @@
+# Array dataset: fixed-shape uint8 plates in a .npy file that training loaders
+# memory-map and slice without decoding anything. Every split is made of
+#   name_images.npy   (N, height, width, 3) uint8
+#   name_boxes.npy    structured BOX_DTYPE, the boxes of every plate one after the other
+#   name_offsets.npy  (N + 1,) int64, the boxes of plate i are boxes[offsets[i]:offsets[i + 1]]
+#   name_meta.json    image shape, number of plates and class names
+# Box coordinates are normalized, like in the TFRecords.
+import io
+import json
+import struct
+import numpy as np
+from PIL import Image
+
+BOX_DTYPE = np.dtype([("xMin", "<f4"), ("yMin", "<f4"), ("xMax", "<f4"), ("yMax", "<f4"), ("classId", "<i4")])
+
+# Room for any shape, the header is rewritten in place once the number of rows is known
+_NPY_HEADER_SIZE = 256
+
+def npyHeader(dtype, shape):
+    header = "{'descr': %s, 'fortran_order': False, 'shape': %s, }" % (repr(np.lib.format.dtype_to_descr(np.dtype(dtype))), repr(tuple(shape)))
+    header = header.ljust(_NPY_HEADER_SIZE - 10 - 1) + "\n"
+    if len(header) + 10 != _NPY_HEADER_SIZE:
+        raise ValueError("NPY header too long for %s" % str(np.dtype(dtype)))
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+class NpyStreamWriter:
+    # Appends rows of a fixed shape to a .npy file whose length is not known in advance
+    def __init__(self, filename, dtype, rowShape=()):
+        self.filename = filename
+        self.dtype    = np.dtype(dtype)
+        self.rowShape = tuple(rowShape)
+        self.numRows  = 0
+        self._file    = open(filename, "wb")
+        self._file.write(npyHeader(self.dtype, (0,) + self.rowShape))
+
+    def append(self, rows):
+        # rows: (n,) + rowShape array
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        if rows.shape[1:] != self.rowShape:
+            raise ValueError("Expected rows of shape %s, got %s" % (str(self.rowShape), str(rows.shape[1:])))
+        self._file.write(rows.tobytes())
+        self.numRows += rows.shape[0]
+        return rows.nbytes
+
+    def close(self):
+        self._file.seek(0)
+        self._file.write(npyHeader(self.dtype, (self.numRows,) + self.rowShape))
+        self._file.close()
+
+
+class ArrayDatasetWriter:
+    def __init__(self, prefix, imageShape=None):
+        # imageShape: (height, width), taken from the first plate when None.
+        # Plates of another shape are resized, normalized boxes stay the same
+        self.prefix     = prefix
+        self.imageShape = tuple(imageShape) if imageShape is not None else None
+        self.images     = None
+        self.boxes      = NpyStreamWriter(prefix + "_boxes.npy", BOX_DTYPE)
+        self.offsets    = [0]
+        self.classes    = {}
+
+    def toArray(self, plateImg):
+        # Plates come as uint8 arrays, PIL images or encoded bytes
+        if isinstance(plateImg, bytes):
+            plateImg = Image.open(io.BytesIO(plateImg))
+        if isinstance(plateImg, Image.Image):
+            plateImg = np.asarray(plateImg.convert("RGB"))
+        if self.imageShape is None:
+            self.imageShape = plateImg.shape[:2]
+        if plateImg.shape[:2] != self.imageShape:
+            height, width = self.imageShape
+            plateImg = np.asarray(Image.fromarray(plateImg).resize((width, height), Image.BILINEAR))
+        return plateImg
+
+    def append(self, plateImg, tfRecordExample):
+        # Boxes and classes are taken from the TFExample built for the plate, returns the bytes written
+        plateImg = self.toArray(plateImg)
+        if self.images is None:
+            self.images = NpyStreamWriter(self.prefix + "_images.npy", np.uint8, self.imageShape + (3,))
+        boxes            = np.empty(len(tfRecordExample.classes), dtype=BOX_DTYPE)
+        boxes["xMin"]    = tfRecordExample.xMins
+        boxes["yMin"]    = tfRecordExample.yMins
+        boxes["xMax"]    = tfRecordExample.xMaxs
+        boxes["yMax"]    = tfRecordExample.yMaxs
+        boxes["classId"] = tfRecordExample.classes
+        for classId, classText in zip(tfRecordExample.classes, tfRecordExample.classesText):
+            self.classes[int(classId)] = classText.decode("utf-8")
+        self.offsets.append(self.offsets[-1] + len(boxes))
+        return self.images.append(plateImg[np.newaxis]) + self.boxes.append(boxes)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def close(self):
+        if self.images is None:
+            # No plate at all, the shape is unknown
+            height, width = self.imageShape if self.imageShape is not None else (0, 0)
+            self.images = NpyStreamWriter(self.prefix + "_images.npy", np.uint8, (height, width, 3))
+        self.images.close()
+        self.boxes.close()
+        np.save(self.prefix + "_offsets.npy", np.asarray(self.offsets, dtype=np.int64))
+        with open(self.prefix + "_meta.json", "w") as file:
+            json.dump({"numOfPlates": len(self),
+                       "imageShape":  list(self.images.rowShape),
+                       "numOfBoxes":  self.offsets[-1],
+                       "classes":     {str(classId): name for classId, name in sorted(self.classes.items())}}, file, indent=2)
+
+
+class ArrayDataset:
+    # Read side, images and boxes are memory-mapped and never copied
+    def __init__(self, prefix):
+        self.prefix  = prefix
+        self.images  = np.load(prefix + "_images.npy", mmap_mode="r")
+        self.boxes   = np.load(prefix + "_boxes.npy", mmap_mode="r")
+        self.offsets = np.load(prefix + "_offsets.npy")
+        with open(prefix + "_meta.json") as file:
+            self.meta = json.load(file)
+        self.classes = {int(classId): name for classId, name in self.meta["classes"].items()}
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        # (image, boxes) views of plate idx
+        return self.images[idx], self.boxes[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def batch(self, start, stop):
+        # Images of plates [start, stop), their boxes and the offsets of the boxes within them
+        offsets = self.offsets[start:stop + 1]
+        return self.images[start:stop], self.boxes[offsets[0]:offsets[-1]], offsets - offsets[0]
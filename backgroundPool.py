@@ -0,0 +1,91 @@
+# Background pool: every background image is decoded and resized only once.
+# Backgrounds live in a bounded LRU, or in a single memory-mapped .npy file
+# whose pages are shared by every worker reading it.
+import os
+import json
+import threading
+import collections
+import numpy as np
+from PIL import Image
+
+class BackgroundPool:
+    def __init__(self, files, size=(800, 600), maxSize=64, cacheFile=None):
+        self.files     = list(files)
+        self.size      = tuple(size)
+        self.maxSize   = maxSize
+        self.cacheFile = cacheFile
+        self.cache     = collections.OrderedDict()
+        self.lock      = threading.Lock()
+        self.images    = None
+
+        if cacheFile is not None:
+            if not self.isCacheValid(cacheFile):
+                self.save(cacheFile)
+            self.load(cacheFile)
+
+    def __len__(self):
+        return len(self.files)
+
+    @staticmethod
+    def metaFile(cacheFile):
+        return cacheFile + ".json"
+
+    def fileKeys(self):
+        # Size and mtime of every background, an edited or replaced file invalidates the cache
+        keys = []
+        for bgFile in self.files:
+            stat = os.stat(bgFile)
+            keys.append([stat.st_size, stat.st_mtime_ns])
+        return keys
+
+    def isCacheValid(self, cacheFile):
+        if not os.path.isfile(cacheFile) or not os.path.isfile(self.metaFile(cacheFile)):
+            return False
+        with open(self.metaFile(cacheFile)) as file:
+            meta = json.load(file)
+        return (meta.get("files") == self.files and tuple(meta.get("size", ())) == self.size and
+                meta.get("fileKeys") == self.fileKeys())
+
+    def loadBackground(self, idx):
+        with Image.open(self.files[idx]) as bgImg:
+            bgImg = bgImg.convert("RGB")
+        return bgImg.resize(self.size, Image.ANTIALIAS)
+
+    def getArray(self, idx):
+        # Returns a (height, width, 3) uint8 copy, callers paste plates onto it
+        if self.images is not None:
+            return np.array(self.images[idx])
+
+        # Pipeline background workers share the LRU
+        with self.lock:
+            background = self.cache.get(idx)
+            if background is not None:
+                self.cache.move_to_end(idx)
+        if background is None:
+            background = np.asarray(self.loadBackground(idx))
+            with self.lock:
+                self.cache[idx] = background
+                if len(self.cache) > self.maxSize:
+                    self.cache.popitem(last=False)
+        return background.copy()
+
+    def choiceArray(self, rng):
+        return self.getArray(rng.randrange(len(self.files)))
+
+    def save(self, cacheFile):
+        # All backgrounds in one (N, height, width, 3) uint8 array
+        width, height = self.size
+        fileKeys      = self.fileKeys()
+        tmpFile = cacheFile + ".tmp"
+        images  = np.lib.format.open_memmap(tmpFile, mode="w+", dtype=np.uint8, shape=(len(self.files), height, width, 3))
+        for idx in range(len(self.files)):
+            images[idx] = np.asarray(self.loadBackground(idx))
+        images.flush()
+        del images
+        os.replace(tmpFile, cacheFile)
+
+        with open(self.metaFile(cacheFile), "w") as file:
+            json.dump({"files": self.files, "size": list(self.size), "fileKeys": fileKeys}, file)
+
+    def load(self, cacheFile):
+        self.images = np.load(cacheFile, mmap_mode="r")
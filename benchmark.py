@@ -0,0 +1,232 @@
+# Per-stage throughput benchmark of the plate generation pipeline.
+# Reports plates/sec and per-plate latency percentiles of every stage, for
+# every plate variant with augmentation on (once per augmentation profile) and off, as JSON.
+#
+# $ python benchmark.py --plates 200 --output bench.json
+# $ python benchmark.py --variants mercosul --augmentation on --profiles full fast --visualize tiers.png
+# $ python benchmark.py --imports  (import time of the core modules, fails if they load heavy dependencies)
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import numpy as np
+from PIL import Image
+from plateGenerator import PlateGenerator, AUGMENTATION_PROFILES
+from TFRecordWriter import TFRecordWriter, TFExample
+
+VARIANTS = {
+    "old":        dict(isMercosul=False),
+    "mercosul":   dict(isMercosul=True),
+    "motorcycle": dict(isMercosul=True, isMotorcycle=True),
+    "red":        dict(isMercosul=False, isMotorcycle=True, isRed=True),
+}
+
+STAGES = ["compose", "augment", "background", "jpeg", "tfrecord"]
+
+# Importing the core must not load these, they are imported on first use
+CORE_MODULES  = ["plateGenerator", "datasetCreator", "imgBBoxExtractor", "TFRecordWriter", "TFRecordReader"]
+HEAVY_MODULES = ["matplotlib", "imgaug", "cv2", "tensorflow", "scipy", "skimage"]
+
+def gitRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def summarize(latencies):
+    latencies = np.asarray(latencies, dtype=np.float64)
+    total     = latencies.sum()
+    return {
+        "plates":       int(len(latencies)),
+        "platesPerSec": float(len(latencies) / total) if total > 0 else None,
+        "meanMs":       float(latencies.mean() * 1000),
+        "p50Ms":        float(np.percentile(latencies, 50) * 1000),
+        "p90Ms":        float(np.percentile(latencies, 90) * 1000),
+        "p99Ms":        float(np.percentile(latencies, 99) * 1000),
+    }
+
+def createExample(img, boxes, idx):
+    height, width                   = img.shape[:2]
+    tfRecordExample                 = TFExample()
+    tfRecordExample.width           = width
+    tfRecordExample.height          = height
+    tfRecordExample.filename        = ("plate_%d" % idx).encode('utf-8')
+    tfRecordExample.sourceID        = str(idx).zfill(7).encode('utf-8')
+    tfRecordExample.imageFormat     = b'jpeg'
+    tfRecordExample.xMins           = [float(box[0]) / width for box in boxes]
+    tfRecordExample.xMaxs           = [float(box[2]) / width for box in boxes]
+    tfRecordExample.yMins           = [float(box[1]) / height for box in boxes]
+    tfRecordExample.yMaxs           = [float(box[3]) / height for box in boxes]
+    tfRecordExample.classesText     = [str(box[4]).encode('utf-8') for box in boxes]
+    tfRecordExample.classes         = [1 for _ in boxes]
+    return tfRecordExample
+
+def benchmarkImport(module):
+    # Every module is imported by a fresh interpreter
+    code   = ("import sys, time, json; start = time.perf_counter(); import %s; elapsed = time.perf_counter() - start; "
+              "print(json.dumps({'seconds': elapsed, 'modules': sorted(set(name.split('.')[0] for name in sys.modules))}))" % module)
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    return {"module":        module,
+            "importSeconds": result["seconds"],
+            "heavyModules":  [name for name in HEAVY_MODULES if name in result["modules"]]}
+
+def benchmarkVariant(variant, augmentation, numOfPlates, warmup, seed, resize=True, profile="full"):
+    generator     = PlateGenerator(showPlates=False, augmentation=augmentation, bgInsertion=True,
+                                   augmentationProfile=profile, **VARIANTS[variant])
+    hasBackground = len(generator.bgFiles) > 0
+    tfRecordGen   = TFRecordWriter(os.devnull)
+    latencies     = {stage: [] for stage in STAGES}
+    totals        = []
+
+    for idx in range(warmup + numOfPlates):
+        rng      = random.Random(seed + idx)
+        timings  = {}
+
+        # String sampling and glyph compositing
+        start = time.perf_counter()
+        img, boxes = generator.composePlate(rng)
+        timings["compose"] = time.perf_counter() - start
+
+        if augmentation:
+            start = time.perf_counter()
+            img, boxes = generator.augmentImg({"plateImg": img, "plateBoxes": boxes}, resize=resize, rng=rng, seed=seed + idx)
+            timings["augment"] = time.perf_counter() - start
+
+        if hasBackground:
+            start = time.perf_counter()
+            img, boxes = generator.insertBackground(img, boxes, rng=rng)
+            timings["background"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        byteStream = io.BytesIO()
+        Image.fromarray(img).save(byteStream, 'jpeg')
+        imageBytes = byteStream.getvalue()
+        timings["jpeg"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tfRecordExample = createExample(img, boxes, idx)
+        tfRecordExample.encodedImageData = imageBytes
+        tfRecordGen.appendExampleToTfStream(tfRecordGen.createTfExample(tfRecordExample))
+        timings["tfrecord"] = time.perf_counter() - start
+
+        if idx < warmup:
+            continue
+        for stage, elapsed in timings.items():
+            latencies[stage].append(elapsed)
+        totals.append(sum(timings.values()))
+
+    tfRecordGen.closeTfStream()
+
+    results = []
+    profile = profile if augmentation else None
+    for stage in STAGES:
+        result = {"variant": variant, "augmentation": augmentation, "profile": profile, "stage": stage}
+        if latencies[stage]:
+            result.update(summarize(latencies[stage]))
+        else:
+            result["skipped"] = "no background images" if stage == "background" else "augmentation disabled"
+        results.append(result)
+    total = {"variant": variant, "augmentation": augmentation, "profile": profile, "stage": "total"}
+    total.update(summarize(totals))
+    results.append(total)
+    return results
+
+def visualizeProfiles(variant, profiles, numOfPlates, seed, filename, resize=True):
+    # The same composed plates augmented by every profile, one row per profile. Titles hold the
+    # augmentation cost and the intensity statistics of the row, to compare the tiers at a glance
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    generators = {profile: PlateGenerator(showPlates=False, augmentation=True, bgInsertion=False,
+                                          augmentationProfile=profile, **VARIANTS[variant]) for profile in profiles}
+    composer   = generators[profiles[0]]
+    plates     = [composer.composePlate(random.Random(seed + idx)) for idx in range(numOfPlates)]
+    figure, axes = plt.subplots(len(profiles), numOfPlates, figsize=(2.2 * numOfPlates, 1.4 * len(profiles)), squeeze=False)
+    for row, profile in enumerate(profiles):
+        images  = []
+        elapsed = 0.0
+        for idx, (img, boxes) in enumerate(plates):
+            start = time.perf_counter()
+            imageAug, _ = generators[profile].augmentImg({"plateImg": img, "plateBoxes": boxes}, resize=resize,
+                                                         rng=random.Random(seed + idx), seed=seed + idx)
+            elapsed += time.perf_counter() - start
+            images.append(imageAug)
+        pixels = np.concatenate([np.asarray(image, dtype=np.float64).ravel() for image in images])
+        axes[row][0].set_title("%s: %.1f ms/plate, mean %.1f, std %.1f" % (profile, elapsed * 1000 / numOfPlates,
+                                                                            pixels.mean(), pixels.std()),
+                               loc="left", fontsize=8)
+        for col, image in enumerate(images):
+            axes[row][col].imshow(image)
+            axes[row][col].axis("off")
+    figure.tight_layout()
+    figure.savefig(filename, dpi=120)
+    plt.close(figure)
+    print("Augmentation profiles written to %s" % filename)
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage throughput benchmark of the plate generator")
+    parser.add_argument("--plates", type=int, default=100, help="measured plates per variant")
+    parser.add_argument("--warmup", type=int, default=5, help="plates generated before measuring")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--variants", nargs="+", default=list(VARIANTS), choices=list(VARIANTS))
+    parser.add_argument("--augmentation", nargs="+", default=["on", "off"], choices=["on", "off"])
+    parser.add_argument("--profiles", nargs="+", default=["full"], choices=list(AUGMENTATION_PROFILES),
+                        help="augmentation profiles measured when augmentation is on")
+    parser.add_argument("--visualize", default=None, metavar="FILE",
+                        help="also save the same plates under every profile, for the first variant")
+    parser.add_argument("--output", default=None, help="JSON file, printed to stdout when omitted")
+    parser.add_argument("--imports", action="store_true", help="only measure the import time of the core modules")
+    parser.add_argument("--max-import-seconds", type=float, default=None, help="fail when an import takes longer")
+    args = parser.parse_args()
+
+    report = {
+        "revision":  gitRevision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python":    platform.python_version(),
+        "machine":   platform.machine(),
+        "cpus":      os.cpu_count(),
+        "plates":    args.plates,
+        "warmup":    args.warmup,
+        "seed":      args.seed,
+        "results":   [],
+    }
+    failures = []
+    if args.imports:
+        for module in CORE_MODULES:
+            result = benchmarkImport(module)
+            report["results"].append(result)
+            if result["heavyModules"]:
+                failures.append("%s imports %s" % (module, ", ".join(result["heavyModules"])))
+            if args.max_import_seconds is not None and result["importSeconds"] > args.max_import_seconds:
+                failures.append("%s takes %.3f seconds to import" % (module, result["importSeconds"]))
+    else:
+        for variant in args.variants:
+            for augmentation in args.augmentation:
+                for profile in (args.profiles if augmentation == "on" else ["full"]):
+                    report["results"].extend(benchmarkVariant(variant, augmentation == "on", args.plates, args.warmup,
+                                                              args.seed, profile=profile))
+        if args.visualize is not None:
+            visualizeProfiles(args.variants[0], args.profiles, 6, args.seed, args.visualize)
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print("Benchmark written to %s" % args.output)
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,111 @@
 #This script generates dataset based on a specific framework structure
 import io
 import os
-import matplotlib.pyplot as plt
+import hashlib
+import collections
+import numpy as np
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 from plateGenerator import PlateGenerator
-from TFRecordWriter import TFRecordWriter, TFExample
+from TFRecordWriter import TFRecordWriter, ShardedTFRecordWriter, TFExample
 from time import time
-from imgBBoxExtractor import RealPlateExtractor
-import numpy as np
+from instrumentation import Instrumentation, NULL_INSTRUMENTATION
+from arrayDataset import ArrayDatasetWriter
+
+# Dataset splits, in the order their ratios are laid out on [0, 1)
+SPLITS = ("train", "val", "test")
 
 class DatasetCreator:
     def __init__(self, numOfPlates, showPlates=False, balanceData=False,
                  showStatistics=False, augmentation=True, trainSet=True,
                  lbFile = False, includeDash=False, realData=False,
                  resize=False, model=0, split=True, outputPath=os.getcwd(),
-                 bgInsertion=False, contourOnly=True):
+                 bgInsertion=False, contourOnly=True, workers=1, seed=None,
+                 numShards=1, encodeWorkers=1, tfBackend='lite', instrumentation=None,
+                 statsFile=None, statsInterval=10.0, statsFormat='json', splitRatios=None, splitBy='index',
+                 segmentationCache=None, arrayShape=None, stageWorkers=None, queueSize=4, generatorOptions=None,
+                 firstPlate=0, statistics=None, batchSize=1, augmentationWorkers=0):
+
+        # Every file name starts with outputPath, e.g. outputPath_train.tfrecord
+        self.outputPath         = outputPath
+        # generatorOptions: PlateGenerator arguments such as {"isMercosul": False, "isMotorcycle": True}.
+        # Generated plates are plates firstPlate, firstPlate + 1... of the seed, and the character statistics
+        # start from statistics, see jobRunner.py
+        self.generatorOptions   = generatorOptions or {}
+        self.firstPlate         = firstPlate
+        self.statistics         = statistics
+
+        # splitRatios: {"train": .8, "val": .1, "test": .1}, splitBy: 'index' or 'string'
+        self.splitRatios        = self.normalizeSplitRatios(splitRatios if splitRatios is not None else {"train": .8, "test": .2})
+        self.splitBy            = splitBy
+        if splitBy not in ('index', 'string'):
+            raise ValueError("Unknown split key %s" % str(splitBy))
+
+        # segmentationCache: JSON file of the real plate boxes, reruns only segment new or changed images
+        self.segmentationCache  = segmentationCache
+        # arrayShape: (height, width) of the plates of the array dataset (model 2), the first plate shape when None
+        self.arrayShape         = arrayShape
+        # stageWorkers: {"compose": 1, "augment": 4, "background": 2}, generated plates go through a threaded
+        # pipeline whose last stages are the encodeWorkers pool and the writer, see PlateGenerator.iterPlatesPipelined
+        self.stageWorkers       = stageWorkers
+        self.queueSize          = queueSize
+        # batchSize: generated plates augmented per imgaug call, augmentationWorkers: imgaug pool processes
+        # of a run without workers or stageWorkers, see PlateGenerator.iterPlates
+        self.batchSize          = batchSize
+        self.augmentationWorkers = augmentationWorkers
+
+        # Stats are exported every statsInterval seconds while the dataset is written
+        if instrumentation is None:
+            instrumentation = Instrumentation() if statsFile is not None else NULL_INSTRUMENTATION
+        self.instrumentation    = instrumentation
+        if statsFile is not None:
+            self.instrumentation.startExporter(statsFile, interval=statsInterval, format=statsFormat)
+        try:
+            self.createDataset(numOfPlates, showPlates, balanceData, showStatistics, augmentation, trainSet, lbFile,
+                               includeDash, realData, resize, model, split, bgInsertion, contourOnly, workers, seed,
+                               numShards, encodeWorkers, tfBackend)
+        finally:
+            if statsFile is not None:
+                self.instrumentation.stopExporter()
+
+    def getStats(self):
+        return self.instrumentation.stats()
+
+    def createDataset(self, numOfPlates, showPlates, balanceData, showStatistics, augmentation, trainSet, lbFile,
+                      includeDash, realData, resize, model, split, bgInsertion, contourOnly, workers, seed,
+                      numShards, encodeWorkers, tfBackend):
 
         if realData:
-            plateGen = RealPlateExtractor()
-            self.plates = plateGen.extractBoxesFromImage(showPlates)
+            # OpenCV is only imported for real data
+            from imgBBoxExtractor import RealPlateExtractor
+
+            # Real plates keep the bytes of their file, they are written without a JPEG round trip.
+            # Balancing needs the statistics of the whole set, otherwise plates are streamed
+            plateGen    = RealPlateExtractor(cacheFile=self.segmentationCache)
+            self.plates = plateGen.iterPlates(showPlates, workers=workers, imageFormat='array' if model == 2 else 'encoded')
+            if balanceData:
+                self.plates = list(self.plates)
         else:
-            plateGen    = PlateGenerator(showPlates=showPlates, augmentation=augmentation, bgInsertion=bgInsertion)
-            self.plates = plateGen.generatePlates(numOfPlates=numOfPlates, trainSet=trainSet, includeDash=includeDash, resize=resize)
-
-        self.balanceData        = balanceData
+            # Generated plates are balanced while they are sampled, and rendered while the dataset is written
+            plateGen    = PlateGenerator(showPlates=showPlates, augmentation=augmentation, bgInsertion=bgInsertion,
+                                         contourOnly=contourOnly, instrumentation=self.instrumentation, arrayOutput=True,
+                                         balanceCharacters=balanceData, **self.generatorOptions)
+            if self.statistics is not None:
+                plateGen.statistics.update(self.statistics)
+            self.plates = plateGen.iterPlates(numOfPlates, includeDash=includeDash, resize=resize,
+                                              workers=workers, seed=seed, stageWorkers=self.stageWorkers,
+                                              queueSize=self.queueSize, firstIndex=self.firstPlate,
+                                              batchSize=self.batchSize, augmentationWorkers=self.augmentationWorkers)
+
+        # Only real data is balanced by dropping boxes, which needs the statistics of the whole set
+        self.balanceData        = balanceData and realData
         self.showStatistics     = showStatistics
         self.labelFile          = lbFile
         self.contourOnly        = contourOnly
         self.includeDash        = includeDash
+        self.numShards          = numShards
+        self.encodeWorkers      = encodeWorkers
+        self.tfBackend          = tfBackend
         self.classes = {"plate": 1}
         if not self.contourOnly:
             self.classes            = { "A": 1, "B": 2, "C":  3,  "D": 4, "E": 5, "F": 6,
@@ -37,115 +116,163 @@ class DatasetCreator:
                                         "6":31, "7":32, "8": 33,  "9":34, "-":35}
 
         statistics             = plateGen.getStatistics()
-        self.maxCharOccurrence = min(val for val in statistics.values() if val > 0)
+        self.statistics        = statistics
+        self.maxCharOccurrence = min(val for val in statistics.values() if val > 0) if self.balanceData else None
         self.occurrenceControl = statistics.fromkeys(statistics, 1)
 
 
+        # Every plate is routed to its split while it is produced, all files are written at once
+        if not split:
+            self.splitRatios = {"train": 1.0}
         if model == 0:
-            if split:
-                train, validation = np.split(self.plates, [int(.8 * len(self.plates))])
-                tfRecordTrainFilename = "%s_train.tfrecord" % output
-                tfRecordTestFilename = "%s_test.tfrecord" % output
-
-                self.createTensorFlowDataset(train, tfRecordTrainFilename)
-                self.createTensorFlowDataset(validation, tfRecordTestFilename)
-            else:
-                tfRecordTrainFilename = "%s_train.tfrecord" % output
-                self.createTensorFlowDataset(self.plates, tfRecordTrainFilename)
+            tfRecordFilenames = collections.OrderedDict((name, "%s_%s.tfrecord" % (self.outputPath, name)) for name in self.splitRatios)
+            self.createTensorFlowDataset(self.plates, tfRecordFilenames)
 
         elif model == 1:
-            self.createYOLOV2Dataset()
+            self.createYOLOV2Dataset(self.plates, self.outputPath)
+        elif model == 2:
+            arrayPrefixes = collections.OrderedDict((name, "%s_%s" % (self.outputPath, name)) for name in self.splitRatios)
+            self.createArrayDataset(self.plates, arrayPrefixes)
         else:
             print("Model not found")
 
 
-    def createYOLOV2Dataset(self):
-        # To be defined
-        print("This feature is under development")
-
-    def createTensorFlowDataset(self, plates, tfRecordFilename):
-        tfLabelMapFilename = "%s_label_map.pbtxt" % output
+    def createYOLOV2Dataset(self, plates, outputDir, batchSize=16):
+        # outputDir/images/split/idx.jpg with its outputDir/labels/split/idx.txt of "class cx cy w h" lines,
+        # outputDir/split.txt lists the images of every split and obj.names/obj.data describe the set
         startTime = time()
         print("------------------------------------------------------------------")
-        print("Generating TensorFlow Dataset with (%d) license plates" % len(plates))
-        tfRecordGen = TFRecordWriter(tfRecordFilename)
+        print("Generating YOLO Dataset - %s" % outputDir)
+        for name in self.splitRatios:
+            for folder in ("images", "labels"):
+                os.makedirs(os.path.join(outputDir, folder, name), exist_ok=True)
+        splitRatios = self.splitRatios
         diffClasses = []
-
-        for idx, plate in enumerate(plates):
-            plateIdx         = plate['plateIdx']
-            plateImg         = plate['plateImg']
-            plateBoxes       = plate['plateBoxes']
-            byteStream       = io.BytesIO()
-            plateImg.save(byteStream, 'jpeg')
-            imageBytes       = byteStream.getvalue()
-            height           = plateImg.height
-            width            = plateImg.width
-            xMins            = []  # List of normalized left x coordinates in bounding box (1 per box)
-            xMaxs            = []  # List of normalized right x coordinates in bounding box (1 per box)
-            yMins            = []  # List of normalized top y coordinates in bounding box (1 per box)
-            yMaxs            = []  # List of normalized bottom y coordinates in bounding box (1 per box)
-            classesText      = []  # List of string class name of bounding box (1 per box)
-            classes          = []  # List of integer class id of bounding box (1 per box)
-            encodedImageData = imageBytes
-            imageFormat      = b'jpeg'
-            groundTruth      = ''
-
-            for box in plateBoxes:
-
-                xMin = box[0]
-                yMin = box[1]
-                xMax = box[2]
-                yMax = box[3]
-                char = box[4]
-
-                if not self.contourOnly:
-                    groundTruth += str(char)
-
-                # increment occurrence counter
-                self.occurrenceControl[str(char)] +=1
-
-                if int(self.occurrenceControl[str(char)]) > int(self.maxCharOccurrence) and self.balanceData == True:
+        numOfPlates = dict.fromkeys(splitRatios, 0)
+        imageLists  = {name: open(os.path.join(outputDir, "%s.txt" % name), "w") for name in splitRatios}
+        batches     = dict((name, []) for name in splitRatios)
+
+        # Every job encodes and writes a whole batch of images and labels, lists are written in order
+        with ThreadPoolExecutor(max_workers=self.encodeWorkers) as executor:
+            pending = collections.deque()
+            for plate in plates:
+                name            = self.splitOf(self.splitKey(plate), splitRatios)
+                tfRecordExample = self.createTfRecordExample(numOfPlates[name], plate, diffClasses)
+
+                # Avoid empty plates
+                if tfRecordExample is None:
                     continue
 
-                if char == "1" or char == "I":
-                    char = "I1"
-                elif char == "0" or char == "O":
-                    char = "O0"
-
-                xMins.append(float(xMin) / float(width))
-                yMins.append(float(yMin) / float(height))
-                xMaxs.append(float(xMax) / float(width))
-                yMaxs.append(float(yMax) / float(height))
-                classesText.append(str(char).encode('utf-8'))
-                classes.append(self.classes[str(char)])
-                if not any(el['classID'] == self.classes[str(char)] for el in diffClasses):
-                    diffClasses.append({"classID":self.classes[str(char)] , "className": str(char)})
+                extension = ".png" if tfRecordExample.imageFormat == b'png' else ".jpg"
+                imageFile = os.path.abspath(os.path.join(outputDir, "images", name, "%07d%s" % (numOfPlates[name], extension)))
+                labelFile = os.path.join(outputDir, "labels", name, "%07d.txt" % numOfPlates[name])
+                batches[name].append((imageFile, labelFile, plate['plateImg'], self.yoloLabels(tfRecordExample)))
+                numOfPlates[name] += 1
+
+                if len(batches[name]) >= batchSize:
+                    pending.append((name, executor.submit(self.writeYOLOBatch, batches[name], self.instrumentation)))
+                    batches[name] = []
+                if len(pending) >= self.encodeWorkers * 2:
+                    name, job = pending.popleft()
+                    imageLists[name].write(job.result())
+            for name, batch in batches.items():
+                if batch:
+                    pending.append((name, executor.submit(self.writeYOLOBatch, batch, self.instrumentation)))
+            while pending:
+                name, job = pending.popleft()
+                imageLists[name].write(job.result())
+
+        for imageList in imageLists.values():
+            imageList.close()
+        classNames = [className for className, _ in sorted(self.classes.items(), key=lambda item: item[1])]
+        with open(os.path.join(outputDir, "obj.names"), "w") as file:
+            file.write("\n".join(classNames) + "\n")
+        with open(os.path.join(outputDir, "obj.data"), "w") as file:
+            file.write("classes = %d\n" % len(classNames))
+            for name in splitRatios:
+                file.write("%s = %s\n" % ("valid" if name == "val" else name, os.path.abspath(os.path.join(outputDir, "%s.txt" % name))))
+            file.write("names = %s\n" % os.path.abspath(os.path.join(outputDir, "obj.names")))
 
-            # Avoid empty plates
-            if len(classes) == 0:
-                continue
+        elapsed = round((time() - startTime),3)
+        for name in splitRatios:
+            print("YOLO dataset created successfully with (%d) license plates! - %s" % (numOfPlates[name], os.path.join(outputDir, "%s.txt" % name)))
+        print("Process took %s seconds" % str(elapsed))
+        if self.showStatistics:
+            self.visualizeStatistics()
 
+    @staticmethod
+    def yoloLabels(tfRecordExample):
+        # "class cx cy w h" lines, YOLO classes start at 0 and boxes are clipped to the image
+        lines = []
+        for classId, xMin, yMin, xMax, yMax in zip(tfRecordExample.classes, tfRecordExample.xMins, tfRecordExample.yMins,
+                                                   tfRecordExample.xMaxs, tfRecordExample.yMaxs):
+            xMin, xMax = min(max(xMin, 0.0), 1.0), min(max(xMax, 0.0), 1.0)
+            yMin, yMax = min(max(yMin, 0.0), 1.0), min(max(yMax, 0.0), 1.0)
+            lines.append("%d %.6f %.6f %.6f %.6f\n" % (classId - 1, (xMin + xMax) / 2, (yMin + yMax) / 2, xMax - xMin, yMax - yMin))
+        return "".join(lines)
+
+    @staticmethod
+    def writeYOLOBatch(batch, instrumentation=NULL_INSTRUMENTATION):
+        # Runs in the encoding pool, returns the lines of the image list
+        imageFiles = []
+        for imageFile, labelFile, plateImg, labels in batch:
+            if isinstance(plateImg, bytes):
+                imageData = plateImg
+            else:
+                with instrumentation.timer("jpeg"):
+                    if isinstance(plateImg, np.ndarray):
+                        plateImg = Image.fromarray(plateImg)
+                    byteStream = io.BytesIO()
+                    plateImg.save(byteStream, 'jpeg')
+                    imageData  = byteStream.getvalue()
+            with instrumentation.timer("write"):
+                with open(imageFile, "wb") as file:
+                    file.write(imageData)
+                with open(labelFile, "w") as file:
+                    file.write(labels)
+            instrumentation.count("examplesWritten")
+            instrumentation.count("bytesWritten", len(imageData) + len(labels))
+            imageFiles.append(imageFile + "\n")
+        return "".join(imageFiles)
+
+    def createTensorFlowDataset(self, plates, tfRecordFilenames):
+        # tfRecordFilenames: {split: filename}, or a single filename that gets every plate
+        if not isinstance(tfRecordFilenames, dict):
+            tfRecordFilenames = {"train": tfRecordFilenames}
+        tfLabelMapFilename = "%s_label_map.pbtxt" % self.outputPath
+        startTime = time()
+        print("------------------------------------------------------------------")
+        print("Generating TensorFlow Dataset - %s" % ", ".join(tfRecordFilenames.values()))
+        tfRecordGens = {}
+        for name, tfRecordFilename in tfRecordFilenames.items():
+            if self.numShards > 1:
+                tfRecordGens[name] = ShardedTFRecordWriter(tfRecordFilename, self.numShards, backend=self.tfBackend)
+            else:
+                tfRecordGens[name] = TFRecordWriter(tfRecordFilename, backend=self.tfBackend)
+        splitRatios = self.splitRatios if len(tfRecordFilenames) > 1 else {name: 1.0 for name in tfRecordFilenames}
+        diffClasses = []
+        numOfPlates = dict.fromkeys(tfRecordFilenames, 0)
 
-            if self.contourOnly:
-                groundTruth = "plate_%s" % (str(idx))
+        # Boxes are filtered in order, JPEG encoding and serialization run in the pool
+        with ThreadPoolExecutor(max_workers=self.encodeWorkers) as executor:
+            pending = collections.deque()
+            for plate in plates:
+                name            = self.splitOf(self.splitKey(plate), splitRatios)
+                tfRecordExample = self.createTfRecordExample(numOfPlates[name], plate, diffClasses)
 
-            # Append data to TFRecord
-            tfRecordExample                  = TFExample()
-            tfRecordExample.width            = width
-            tfRecordExample.height           = height
-            tfRecordExample.filename         = ("%s" % groundTruth).encode('utf-8')
-            tfRecordExample.sourceID         = (str(plateIdx).zfill(7)).encode('utf-8')
-            tfRecordExample.encodedImageData = encodedImageData
-            tfRecordExample.imageFormat      = imageFormat
-            tfRecordExample.xMins            = xMins
-            tfRecordExample.xMaxs            = xMaxs
-            tfRecordExample.yMins            = yMins
-            tfRecordExample.yMaxs            = yMaxs
-            tfRecordExample.classesText      = classesText
-            tfRecordExample.classes          = classes
+                # Avoid empty plates
+                if tfRecordExample is None:
+                    continue
+                numOfPlates[name] += 1
 
-            tfExample = tfRecordGen.createTfExample(tfRecordExample)
-            tfRecordGen.appendExampleToTfStream(tfExample)
+                pending.append((name, executor.submit(self.serializeTfRecordExample, tfRecordGens[name], tfRecordExample,
+                                                      plate['plateImg'], self.instrumentation)))
+                if len(pending) >= self.encodeWorkers * 4:
+                    name, job = pending.popleft()
+                    self.writeSerializedExample(tfRecordGens[name], job.result())
+            while pending:
+                name, job = pending.popleft()
+                self.writeSerializedExample(tfRecordGens[name], job.result())
 
         # Create pbtxt if specified
         if self.labelFile:
@@ -153,12 +280,183 @@ class DatasetCreator:
             diffClasses = sorted(diffClasses, key=lambda d: d['classID'], reverse=False)
             self.createTFLabelMap(diffClasses, tfLabelMapFilename)
 
-        tfRecordGen.closeTfStream()
+        for tfRecordGen in tfRecordGens.values():
+            tfRecordGen.closeTfStream()
+        elapsed = round((time() - startTime),3)
+        for name, tfRecordFilename in tfRecordFilenames.items():
+            print("TensorFlow dataset created successfully with (%d) license plates! - %s" % (numOfPlates[name], str(tfRecordFilename)))
+        print("Process took %s seconds" % str(elapsed))
+        if self.showStatistics:
+            self.visualizeStatistics()
+
+    def createArrayDataset(self, plates, arrayPrefixes):
+        # arrayPrefixes: {split: prefix of the array files}, see arrayDataset.py
+        startTime = time()
+        print("------------------------------------------------------------------")
+        print("Generating Array Dataset - %s" % ", ".join(arrayPrefixes.values()))
+        arrayWriters = {name: ArrayDatasetWriter(prefix, self.arrayShape) for name, prefix in arrayPrefixes.items()}
+        splitRatios  = self.splitRatios if len(arrayPrefixes) > 1 else {name: 1.0 for name in arrayPrefixes}
+        diffClasses  = []
+
+        for plate in plates:
+            name            = self.splitOf(self.splitKey(plate), splitRatios)
+            tfRecordExample = self.createTfRecordExample(len(arrayWriters[name]), plate, diffClasses)
+
+            # Avoid empty plates
+            if tfRecordExample is None:
+                continue
+
+            with self.instrumentation.timer("write"):
+                bytesWritten = arrayWriters[name].append(plate['plateImg'], tfRecordExample)
+            self.instrumentation.count("examplesWritten")
+            self.instrumentation.count("bytesWritten", bytesWritten)
+
+        for arrayWriter in arrayWriters.values():
+            arrayWriter.close()
         elapsed = round((time() - startTime),3)
-        print("TensorFlow dataset created successfully! - %s - Process took %s seconds" % (str(tfRecordFilename), str(elapsed)))
+        for name, prefix in arrayPrefixes.items():
+            print("Array dataset created successfully with (%d) license plates! - %s_images.npy" % (len(arrayWriters[name]), prefix))
+        print("Process took %s seconds" % str(elapsed))
         if self.showStatistics:
             self.visualizeStatistics()
 
+    @staticmethod
+    def normalizeSplitRatios(splitRatios):
+        unknown = set(splitRatios) - set(SPLITS)
+        if unknown:
+            raise ValueError("Unknown splits %s, use %s" % (", ".join(sorted(unknown)), ", ".join(SPLITS)))
+        if any(ratio < 0 for ratio in splitRatios.values()) or sum(splitRatios.values()) <= 0:
+            raise ValueError("Split ratios must be positive")
+        total = float(sum(splitRatios.values()))
+        return collections.OrderedDict((name, splitRatios[name] / total) for name in SPLITS if splitRatios.get(name, 0) > 0)
+
+    def splitKey(self, plate):
+        # The plate string keeps its split when plate indices change, e.g. with another seed
+        if self.splitBy == 'string':
+            chars = "".join(str(box[4]) for box in plate['plateBoxes'] if box[4] != "plate")
+            if chars:
+                return chars
+        return plate['plateIdx']
+
+    @staticmethod
+    def splitOf(key, splitRatios):
+        # Deterministic: a hash of the key picks a point of [0, 1), the ratios partition it
+        digest = hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest()
+        point  = int.from_bytes(digest, 'little') / 2.0 ** 64
+        upper  = 0.0
+        for name, ratio in splitRatios.items():
+            upper += ratio
+            if point < upper:
+                return name
+        return name
+
+    def createTfRecordExample(self, idx, plate, diffClasses):
+        # Returns None when every box of the plate was dropped
+        plateIdx         = plate['plateIdx']
+        plateImg         = plate['plateImg']
+        plateBoxes       = plate['plateBoxes']
+        height, width    = self.imageSize(plateImg)
+        xMins            = []  # List of normalized left x coordinates in bounding box (1 per box)
+        xMaxs            = []  # List of normalized right x coordinates in bounding box (1 per box)
+        yMins            = []  # List of normalized top y coordinates in bounding box (1 per box)
+        yMaxs            = []  # List of normalized bottom y coordinates in bounding box (1 per box)
+        classesText      = []  # List of string class name of bounding box (1 per box)
+        classes          = []  # List of integer class id of bounding box (1 per box)
+        imageFormat      = self.imageFormat(plateImg)
+        groundTruth      = ''
+
+        for box in plateBoxes:
+
+            xMin = box[0]
+            yMin = box[1]
+            xMax = box[2]
+            yMax = box[3]
+            char = box[4]
+
+            if not self.contourOnly:
+                groundTruth += str(char)
+
+            # increment occurrence counter
+            self.occurrenceControl[str(char)] +=1
+
+            if self.balanceData == True and int(self.occurrenceControl[str(char)]) > int(self.maxCharOccurrence):
+                self.instrumentation.count("boxesDropped")
+                continue
+
+            if char == "1" or char == "I":
+                char = "I1"
+            elif char == "0" or char == "O":
+                char = "O0"
+
+            xMins.append(float(xMin) / float(width))
+            yMins.append(float(yMin) / float(height))
+            xMaxs.append(float(xMax) / float(width))
+            yMaxs.append(float(yMax) / float(height))
+            classesText.append(str(char).encode('utf-8'))
+            classes.append(self.classes[str(char)])
+            if not any(el['classID'] == self.classes[str(char)] for el in diffClasses):
+                diffClasses.append({"classID":self.classes[str(char)] , "className": str(char)})
+
+        if len(classes) == 0:
+            self.instrumentation.count("platesSkipped")
+            return None
+
+        if self.contourOnly:
+            groundTruth = "plate_%s" % (str(idx))
+
+        # Append data to TFRecord
+        tfRecordExample                  = TFExample()
+        tfRecordExample.width            = width
+        tfRecordExample.height           = height
+        tfRecordExample.filename         = ("%s" % groundTruth).encode('utf-8')
+        tfRecordExample.sourceID         = (str(plateIdx).zfill(7)).encode('utf-8')
+        tfRecordExample.imageFormat      = imageFormat
+        tfRecordExample.xMins            = xMins
+        tfRecordExample.xMaxs            = xMaxs
+        tfRecordExample.yMins            = yMins
+        tfRecordExample.yMaxs            = yMaxs
+        tfRecordExample.classesText      = classesText
+        tfRecordExample.classes          = classes
+        return tfRecordExample
+
+    @staticmethod
+    def imageSize(plateImg):
+        # Generated plates are uint8 arrays, real ones the encoded bytes of their file or PIL images
+        if isinstance(plateImg, np.ndarray):
+            return plateImg.shape[:2]
+        if isinstance(plateImg, bytes):
+            width, height = Image.open(io.BytesIO(plateImg)).size
+            return height, width
+        return plateImg.height, plateImg.width
+
+    @staticmethod
+    def imageFormat(plateImg):
+        # Encoded images are stored as they are, everything else is encoded to JPEG
+        if isinstance(plateImg, bytes):
+            return Image.open(io.BytesIO(plateImg)).format.lower().encode('utf-8')
+        return b'jpeg'
+
+    @staticmethod
+    def serializeTfRecordExample(tfRecordGen, tfRecordExample, plateImg, instrumentation=NULL_INSTRUMENTATION):
+        # Runs in the encoding pool
+        if isinstance(plateImg, bytes):
+            tfRecordExample.encodedImageData = plateImg
+        else:
+            with instrumentation.timer("jpeg"):
+                if isinstance(plateImg, np.ndarray):
+                    plateImg = Image.fromarray(plateImg)
+                byteStream                       = io.BytesIO()
+                plateImg.save(byteStream, 'jpeg')
+                tfRecordExample.encodedImageData = byteStream.getvalue()
+        with instrumentation.timer("serialize"):
+            return tfRecordGen.createTfExample(tfRecordExample).SerializeToString()
+
+    def writeSerializedExample(self, tfRecordGen, serializedTfExample):
+        with self.instrumentation.timer("write"):
+            tfRecordGen.appendSerializedExampleToTfStream(serializedTfExample)
+        self.instrumentation.count("examplesWritten")
+        self.instrumentation.count("bytesWritten", len(serializedTfExample))
+
     def createTFLabelMap(self, diffClasses, outputPath):
         file = open(outputPath, 'a+')
         for cls in diffClasses:
@@ -166,6 +464,7 @@ class DatasetCreator:
         file.close()
 
     def visualizeStatistics(self):
+        import matplotlib.pyplot as plt
         plt.figure()
         plt.title("Characters Histogram")
         plt.bar(self.occurrenceControl.keys(), self.occurrenceControl.values(), 1, color='r')
@@ -180,7 +479,7 @@ if __name__ == '__main__':
     path             = os.getcwd()
     realData         = input("Want to use real data? (y/n):")
     output           = input("What is the set name? ")
-    model            = int(input("0 - Tensorflow \n1 - YOLOV2\nWhat is the model? (e.g: 0 or 1): "))
+    model            = int(input("0 - Tensorflow \n1 - YOLOV2\n2 - Arrays (.npy)\nWhat is the model? (e.g: 0, 1 or 2): "))
     resize           = input("Want to resize the image? (y/n): ")
     if realData == ('n' or 'N'):
         numOfPlates  = int(input("How many plates do you want to generate? \nNumber of plates:"))
@@ -193,7 +492,7 @@ if __name__ == '__main__':
     lblFile          = input("Want to generate the label pbtxt file? (y/n): ")
     showPlates       = input("Want to see generated plates? (y/n): ")
 
-    if (int(numOfPlates) > 0 or realData == ('y' or 'Y')) and (model == 0 or model == 1) and output != "":
+    if (int(numOfPlates) > 0 or realData == ('y' or 'Y')) and (model == 0 or model == 1 or model == 2) and output != "":
         output = os.path.join(path, output)
 
         if realData == ('y' or 'Y'): realData = True
@@ -0,0 +1,64 @@
+# Fog and spatter look-alikes for the 'fast' augmentation profile. imgcorruptlike
+# Fog and Spatter build fractal and noise fields at full resolution (and seed the
+# global NumPy state). Here coarse random fields are upsampled and blended into
+# the plate, so the cost is a few passes over the pixels whatever the draw. Both
+# follow the formulas of the effects they replace at severity 2, and are tuned to
+# change the plates as much (benchmark.py --visualize compares the tiers).
+# Both only use the random state they are given, they are safe in threads.
+import numpy as np
+
+def importCv2():
+    import cv2
+    return cv2
+
+def fractalField(rng, height, width, octaves=4, decay=0.5):
+    # Sum of upsampled random grids, each twice as fine and decay times as strong as the last,
+    # scaled to [0, 1] like the plasma fractal of imgcorruptlike Fog
+    cv2   = importCv2()
+    field = np.zeros((height, width), dtype=np.float32)
+    for octave in range(octaves):
+        rows   = min(height, 2 * 2 ** octave)
+        cols   = min(width, 4 * 2 ** octave)
+        grid   = rng.random((rows, cols)).astype(np.float32)
+        field += cv2.resize(grid, (width, height), interpolation=cv2.INTER_CUBIC) * np.float32(decay ** octave)
+    field -= field.min()
+    return field / max(float(field.max()), 1e-6)
+
+def fog(image, rng, strength=(1.5, 2.5)):
+    # Adds strength * field and rescales, pulling the plate toward a patchy haze: x' = (x + s * f) * m / (m + s)
+    height, width = image.shape[:2]
+    scale         = np.float32(rng.uniform(*strength))
+    field         = fractalField(rng, height, width) * scale
+    foggy         = image.astype(np.float32) / np.float32(255)
+    maxVal        = foggy.max()
+    foggy         = (foggy + field[..., np.newaxis]) * (maxVal / (maxVal + scale))
+    return (np.clip(foggy, 0.0, 1.0) * 255).astype(np.uint8)
+
+def spatter(image, rng, coverage=(0.03, 0.12)):
+    # Blobs covering a coverage share of the plate: dark mud, or water drops that refract
+    # (shift and blur) and darken the plate behind them
+    cv2           = importCv2()
+    height, width = image.shape[:2]
+    noise         = rng.random((max(2, height // 8), max(2, width // 8))).astype(np.float32)
+    noise         = cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+    # Threshold on the smooth field, the blobs cover the drawn share of the pixels
+    share         = rng.uniform(*coverage)
+    kth           = min(noise.size - 1, int(noise.size * (1.0 - share)))
+    threshold     = np.partition(noise.ravel(), kth)[kth]
+    mask          = cv2.GaussianBlur((noise > threshold).astype(np.float32), (3, 3), 0)[..., np.newaxis]
+    spattered     = image.astype(np.float32)
+    if rng.random(()) < 0.5:
+        drops = np.array([rng.uniform(40, 90), rng.uniform(30, 60), rng.uniform(20, 40)], dtype=np.float32)
+    else:
+        shift = (int(rng.integers(-4, 5)), int(rng.integers(-4, 5)))
+        drops = cv2.blur(np.roll(spattered, shift, axis=(0, 1)), (5, 5)) * np.float32(rng.uniform(0.55, 0.8))
+    spattered    += (drops - spattered) * (mask * np.float32(0.85))
+    return spattered.astype(np.uint8)
+
+# imgaug Lambda callbacks, module level functions so augmenters can be pickled
+
+def fogImages(images, random_state, parents, hooks):
+    return [fog(image, random_state) for image in images]
+
+def spatterImages(images, random_state, parents, hooks):
+    return [spatter(image, random_state) for image in images]
@@ -0,0 +1,109 @@
+# Glyph atlas: every character of a plate variant decoded, resized and
+# converted to RGBA only once, so plate generation never touches the disk.
+import os
+import numpy as np
+from PIL import Image
+
+# Atlases already built in this process, keyed by their signature
+_sharedAtlases = {}
+
+class GlyphAtlas:
+    def __init__(self, dataFolder, letters, numbers, isMercosul=True, isMotorcycle=False, cacheFile=None):
+        self.dataFolder   = dataFolder
+        self.letters      = list(letters)
+        self.numbers      = list(numbers)
+        self.isMercosul   = isMercosul
+        self.isMotorcycle = isMotorcycle
+        self.signature    = self.buildSignature(dataFolder, isMercosul, isMotorcycle)
+        self.letterGlyphs = {}
+        self.numberGlyphs = {}
+
+        if cacheFile is not None and os.path.isfile(cacheFile) and self.load(cacheFile):
+            return
+
+        self.build()
+        if cacheFile is not None:
+            self.save(cacheFile)
+
+    @staticmethod
+    def buildSignature(dataFolder, isMercosul, isMotorcycle):
+        return "%s|mercosul=%d|motorcycle=%d" % (os.path.normpath(dataFolder), int(isMercosul), int(isMotorcycle))
+
+    @classmethod
+    def shared(cls, dataFolder, letters, numbers, isMercosul=True, isMotorcycle=False, cacheFile=None):
+        # One atlas per variant and per process
+        signature = cls.buildSignature(dataFolder, isMercosul, isMotorcycle)
+        if signature not in _sharedAtlases:
+            _sharedAtlases[signature] = cls(dataFolder, letters, numbers, isMercosul=isMercosul,
+                                            isMotorcycle=isMotorcycle, cacheFile=cacheFile)
+        return _sharedAtlases[signature]
+
+    def glyphFile(self, char):
+        # Old plates share the same glyph for I/1 and O/0
+        file = char
+        if not self.isMercosul:
+            if char == "I" or char == "1":
+                file = "I1"
+            if char == "O" or char == "0":
+                file = "O0"
+        return os.path.join(self.dataFolder, "%s.png" % str(file))
+
+    def letterSize(self):
+        if self.isMercosul:
+            return (70, 110)
+        if self.isMotorcycle:
+            return (90, 130)
+        return None
+
+    def numberSize(self):
+        if self.isMercosul:
+            return (70, 110)
+        if self.isMotorcycle:
+            return (80, 120)
+        return None
+
+    @staticmethod
+    def loadGlyph(filename, size=None):
+        with Image.open(filename) as glyph:
+            glyph = glyph.convert("RGBA")
+        if size is not None:
+            glyph = glyph.resize(size)
+        return glyph
+
+    def build(self):
+        for letter in self.letters:
+            self.letterGlyphs[letter] = self.loadGlyph(self.glyphFile(letter), self.letterSize())
+        for number in self.numbers:
+            self.numberGlyphs[number] = self.loadGlyph(self.glyphFile(number), self.numberSize())
+
+    def letter(self, char):
+        return self.letterGlyphs[char]
+
+    def number(self, char):
+        return self.numberGlyphs[char]
+
+    def save(self, cacheFile):
+        # Every glyph is stored as a RGBA array inside a single .npz file
+        arrays = {"signature": np.array(self.signature)}
+        for char, glyph in self.letterGlyphs.items():
+            arrays["letter_%s" % char] = np.asarray(glyph)
+        for char, glyph in self.numberGlyphs.items():
+            arrays["number_%s" % char] = np.asarray(glyph)
+
+        tmpFile = cacheFile + ".tmp.npz"
+        np.savez(tmpFile, **arrays)
+        os.replace(tmpFile, cacheFile)
+
+    def load(self, cacheFile):
+        # Returns False when the cache file belongs to another variant
+        with np.load(cacheFile) as cache:
+            if "signature" not in cache.files or str(cache["signature"]) != self.signature:
+                return False
+            files = set(cache.files)
+            if any(("letter_%s" % char) not in files for char in self.letters) or \
+               any(("number_%s" % char) not in files for char in self.numbers):
+                return False
+
+            self.letterGlyphs = {char: Image.fromarray(cache["letter_%s" % char], "RGBA") for char in self.letters}
+            self.numberGlyphs = {char: Image.fromarray(cache["number_%s" % char], "RGBA") for char in self.numbers}
+        return True
@@ -1,11 +1,12 @@
 # Code developed by Flavio (AI2BIZ) and adapted by Fernando Rodrigues Jr
-import cv2
+import io
 import numpy as np
 import configs.extractor_config as extractorCfg
 import os
 from PIL import Image, ImageDraw
 import collections
-import matplotlib.pyplot as plt
+import multiprocessing
+from segmentationCache import SegmentationCache
 
 maxCharWidth         = extractorCfg.CONFIGS['maxCharWidthFactor']
 minCharWidth         = extractorCfg.CONFIGS['minCharWidthFactor']
@@ -15,9 +16,18 @@ pathToTrainImageDir  = extractorCfg.CONFIGS['trainImageDir']
 imageType            = extractorCfg.CONFIGS['imageType']
 numOfChars           = extractorCfg.CONFIGS['numOfChars']
 
+IMAGE_FORMATS        = ('pil', 'array', 'encoded')
+
+def importCv2():
+    # OpenCV is loaded on first use, importing the module stays cheap
+    import cv2
+    return cv2
+
 class RealPlateExtractor:
 
-    def __init__(self):
+    def __init__(self, cacheFile=None):
+        # cacheFile: JSON segmentation cache, only new or changed images are segmented again
+        self.cache      = SegmentationCache(cacheFile, extractorCfg.CONFIGS) if cacheFile is not None else None
         self.statistics = collections.OrderedDict([("A", 0), ("B", 0), ("C", 0), ("D", 0), ("E", 0),
                                                    ("F", 0), ("G", 0), ("H", 0), ("I", 0), ("J", 0),
                                                    ("K", 0), ("L", 0), ("M", 0), ("N", 0), ("O", 0),
@@ -42,11 +52,13 @@ class RealPlateExtractor:
 
 
     def enhance(self, img):
+        cv2 = importCv2()
         kernel = np.array([[-1, 0, 1], [-2, 0, 2], [1, 0, 1]])
         return cv2.filter2D(img, -1, kernel)
 
     # Do char segmentation
     def segmentChars(self, loadedImg, basename):
+        cv2 = importCv2()
         # Load the radar image
         img = loadedImg
         height, width = img.shape[:2]
@@ -66,8 +78,8 @@ class RealPlateExtractor:
         # Apply adaptive threshold with Otsu
         ret, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
 
-        # Find the contours
-        _, contours, hierarchy = cv2.findContours(thresh, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+        # Find the contours, OpenCV 3 returns (image, contours, hierarchy) and OpenCV 4 (contours, hierarchy)
+        contours = cv2.findContours(thresh, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)[-2]
 
         # For each contour, find the bounding rectangle and draw it
         for cnt in contours:
@@ -86,34 +98,116 @@ class RealPlateExtractor:
     def getStatistics(self):
         return self.statistics
 
-    def extractBoxesFromImage(self, showPlates=False):
-        trainImages = [os.path.join(pathToTrainImageDir, file) for file in os.listdir(pathToTrainImageDir) if
-                       file.endswith(imageType)]
-
-        plates = []
-        imgId  = 0
-        for image in trainImages:
+    def extractBoxesFromImage(self, showPlates=False, workers=1, imageFormat='pil'):
+        return list(self.iterPlates(showPlates=showPlates, workers=workers, imageFormat=imageFormat))
+
+    def trainImages(self):
+        return sorted(os.path.join(pathToTrainImageDir, file) for file in os.listdir(pathToTrainImageDir) if
+                      file.endswith(imageType))
+
+    def iterPlates(self, showPlates=False, workers=1, imageFormat='pil'):
+        # Lazily yields the accepted plates in file order
+        # imageFormat: 'pil', 'array' (RGB uint8) or 'encoded' (the bytes of the file, not re-encoded)
+        if imageFormat not in IMAGE_FORMATS:
+            raise ValueError("Unknown image format %s" % str(imageFormat))
+        trainImages = self.trainImages()
+        tasks       = [self.extractTask(image) for image in trainImages]
+        if workers > 1:
+            results = self.iterExtractParallel(tasks, workers, imageFormat)
+        else:
+            results = (self.extractPlate(image, imageFormat, cached) for image, _, cached in tasks)
+
+        imgId = 0
+        try:
+            for (image, fileKey, cached), (boxes, plateImg) in zip(tasks, results):
+                if self.cache is not None and cached is None:
+                    self.cache.put(image, fileKey, boxes, plateImg is not None)
+                if plateImg is None:
+                    continue
+
+                plate = {"plateIdx": imgId, "plateImg": plateImg, "plateBoxes": boxes}
+                imgId += 1
+
+                if showPlates:
+                    self.visualizePlate(self.toImage(plateImg), boxes)
+                yield plate
+        finally:
+            # Also saved when the caller stops early, the images segmented so far are kept
+            if self.cache is not None:
+                self.cache.prune(trainImages)
+                self.cache.save()
+                print("Segmentation cache: %d images reused, %d segmented" % (self.cache.hits, self.cache.misses))
+
+    def extractTask(self, image):
+        # (image, fileKey, cached entry or None)
+        if self.cache is None:
+            return image, None, None
+        fileKey = self.cache.fileKey(image)
+        return image, fileKey, self.cache.get(image, fileKey)
+
+    def iterExtractParallel(self, tasks, workers, imageFormat, chunkSize=32):
+        with multiprocessing.Pool(workers, initializer=_initWorker) as pool:
+            # Only a couple of chunks per worker are in flight, results are consumed in file order
+            pending = collections.deque()
+            for start in range(0, len(tasks), chunkSize):
+                pending.append(pool.apply_async(_extractChunk, (tasks[start:start + chunkSize], imageFormat)))
+                if len(pending) >= workers * 2:
+                    for result in self.mergeChunk(pending.popleft().get()):
+                        yield result
+            while pending:
+                for result in self.mergeChunk(pending.popleft().get()):
+                    yield result
+
+    def mergeChunk(self, results):
+        # segmentChars counted the tags in the worker, they are counted again here
+        for boxes, _ in results:
+            for box in boxes:
+                self.statistics[box[4]] += 1
+        return results
+
+    def extractPlate(self, image, imageFormat='pil', cached=None):
+        # Returns (boxes, plateImg), plateImg is None when the plate is rejected.
+        # Cached plates are not segmented, rejected ones are not even read
+        if cached is not None:
+            boxes = [tuple(box) for box in cached["boxes"]]
+            for box in boxes:
+                self.statistics[box[4]] += 1
+            if not cached["accepted"]:
+                return boxes, None
+
+        with open(image, 'rb') as file:
+            data = file.read()
+        if cached is not None and imageFormat == 'encoded':
+            return boxes, data
+        cv2 = importCv2()
+        loadedImg = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        loadedImg = cv2.cvtColor(loadedImg, cv2.COLOR_BGR2RGB)
+
+        if cached is None:
             basename = (os.path.basename(image).split("."))[0]
             basename = list(basename)
             if "-" in basename:
                 basename.remove("-")
-
-            loadedImg = cv2.imread(image)
-            loadedImg = cv2.cvtColor(loadedImg, cv2.COLOR_BGR2RGB)
             boxes = self.segmentChars(loadedImg, basename)
-
             if len(boxes) != numOfChars:
-                continue
-
-            plates.append({"plateIdx": imgId, "plateImg": Image.fromarray(loadedImg), "plateBoxes": boxes})
-            imgId += 1
-
-            if showPlates:
-                self.visualizePlate(Image.fromarray(loadedImg), boxes)
-
-        return plates
+                return boxes, None
+
+        if imageFormat == 'encoded':
+            return boxes, data
+        if imageFormat == 'array':
+            return boxes, loadedImg
+        return boxes, Image.fromarray(loadedImg)
+
+    @staticmethod
+    def toImage(plateImg):
+        if isinstance(plateImg, bytes):
+            return Image.open(io.BytesIO(plateImg))
+        if isinstance(plateImg, np.ndarray):
+            return Image.fromarray(plateImg)
+        return plateImg
 
     def visualizePlate(self, image, boxes):
+        import matplotlib.pyplot as plt
         draw = ImageDraw.Draw(image)
         for box in boxes:
             draw.rectangle([(box[0], box[1]), (box[2], box[3])], None, (0,255,0))
@@ -121,6 +215,17 @@ class RealPlateExtractor:
         plt.imshow(image)
         plt.show()
 
+# Extractor owned by each worker process of iterExtractParallel
+_workerExtractor = None
+
+def _initWorker():
+    global _workerExtractor
+    _workerExtractor = RealPlateExtractor()
+
+def _extractChunk(tasks, imageFormat):
+    return [_workerExtractor.extractPlate(image, imageFormat, cached) for image, _, cached in tasks]
+
+
 if __name__ == '__main__':
     realPlateExtractor = RealPlateExtractor()
     plates = realPlateExtractor.extractBoxesFromImage()
\ No newline at end of file
@@ -0,0 +1,184 @@
+# Instrumentation of the generation hot path: per-stage timers and counters,
+# readable through stats() and periodically exported to a JSON or Prometheus
+# text file while a job runs. NULL_INSTRUMENTATION does nothing, it is the
+# default so disabled instrumentation costs a method call per stage.
+import os
+import re
+import json
+import time
+import threading
+
+EXPORT_FORMATS = ('json', 'prometheus')
+
+class _Timer:
+    __slots__ = ('instrumentation', 'stage', 'start')
+
+    def __init__(self, instrumentation, stage):
+        self.instrumentation = instrumentation
+        self.stage           = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrumentation.addTime(self.stage, time.perf_counter() - self.start)
+        return False
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class Instrumentation:
+    enabled = True
+
+    def __init__(self, prefix="brplategen"):
+        self.prefix    = prefix
+        self.lock      = threading.Lock()
+        self.counters  = {}
+        self.timers    = {}
+        self.startTime = time.time()
+        self._exporter = None
+        self._stop     = None
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timer(self, stage):
+        # with instrumentation.timer("augment"): ...
+        return _Timer(self, stage)
+
+    def addTime(self, stage, elapsed, calls=1):
+        with self.lock:
+            timer = self.timers.get(stage)
+            if timer is None:
+                timer = self.timers[stage] = {"calls": 0, "seconds": 0.0, "maxSeconds": 0.0}
+            timer["calls"]      += calls
+            timer["seconds"]    += elapsed
+            timer["maxSeconds"]  = max(timer["maxSeconds"], elapsed)
+
+    def stats(self):
+        # Snapshot, safe to serialize while the job keeps running
+        with self.lock:
+            return {"uptimeSeconds": time.time() - self.startTime,
+                    "counters":      dict(self.counters),
+                    "timers":        {stage: dict(timer) for stage, timer in self.timers.items()}}
+
+    def merge(self, stats):
+        # Adds the stats() of another process, e.g. a generation worker
+        with self.lock:
+            for name, value in stats["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for stage, other in stats["timers"].items():
+                timer = self.timers.setdefault(stage, {"calls": 0, "seconds": 0.0, "maxSeconds": 0.0})
+                timer["calls"]      += other["calls"]
+                timer["seconds"]    += other["seconds"]
+                timer["maxSeconds"]  = max(timer["maxSeconds"], other["maxSeconds"])
+
+    def reset(self):
+        with self.lock:
+            self.counters  = {}
+            self.timers    = {}
+            self.startTime = time.time()
+
+    def toJson(self):
+        return json.dumps(self.stats(), indent=2, sort_keys=True)
+
+    @staticmethod
+    def metricName(name):
+        # platesRendered -> plates_rendered
+        return re.sub(r'(?<=[a-z0-9])([A-Z])', r'_\1', name).lower()
+
+    def toPrometheus(self):
+        stats = self.stats()
+        lines = ["# TYPE %s_uptime_seconds gauge" % self.prefix,
+                 "%s_uptime_seconds %f" % (self.prefix, stats["uptimeSeconds"])]
+        for name, value in sorted(stats["counters"].items()):
+            metric = "%s_%s_total" % (self.prefix, self.metricName(name))
+            lines.append("# TYPE %s counter" % metric)
+            lines.append("%s %s" % (metric, value))
+        if stats["timers"]:
+            metric = "%s_stage_seconds" % self.prefix
+            lines.append("# TYPE %s summary" % metric)
+            for stage, timer in sorted(stats["timers"].items()):
+                lines.append('%s_sum{stage="%s"} %f' % (metric, stage, timer["seconds"]))
+                lines.append('%s_count{stage="%s"} %d' % (metric, stage, timer["calls"]))
+            lines.append("# TYPE %s_stage_max_seconds gauge" % self.prefix)
+            for stage, timer in sorted(stats["timers"].items()):
+                lines.append('%s_stage_max_seconds{stage="%s"} %f' % (self.prefix, stage, timer["maxSeconds"]))
+        return "\n".join(lines) + "\n"
+
+    def export(self, filename, format='json'):
+        # Written to a temporary file first, readers never see a partial file
+        if format not in EXPORT_FORMATS:
+            raise ValueError("Unknown stats format %s" % str(format))
+        content = self.toJson() if format == 'json' else self.toPrometheus()
+        tmpFile = filename + ".tmp"
+        with open(tmpFile, "w") as file:
+            file.write(content)
+        os.replace(tmpFile, filename)
+
+    def startExporter(self, filename, interval=10.0, format='json'):
+        if format not in EXPORT_FORMATS:
+            raise ValueError("Unknown stats format %s" % str(format))
+        self.stopExporter()
+        self._stop     = threading.Event()
+        self._exporter = threading.Thread(target=self._exportLoop, args=(filename, interval, format, self._stop),
+                                          name="stats-exporter", daemon=True)
+        self._exporter.start()
+
+    def stopExporter(self):
+        # The loop writes a last file once stopped, so the final numbers are never lost
+        if self._exporter is None:
+            return
+        self._stop.set()
+        self._exporter.join()
+        self._exporter = None
+        self._stop     = None
+
+    def _exportLoop(self, filename, interval, format, stop):
+        while not stop.wait(interval):
+            self.export(filename, format)
+        self.export(filename, format)
+
+
+class NullInstrumentation(Instrumentation):
+    enabled = False
+
+    def __init__(self):
+        self.prefix = "brplategen"
+
+    def count(self, name, value=1):
+        pass
+
+    def timer(self, stage):
+        return _NULL_TIMER
+
+    def addTime(self, stage, elapsed, calls=1):
+        pass
+
+    def stats(self):
+        return {"uptimeSeconds": 0.0, "counters": {}, "timers": {}}
+
+    def merge(self, stats):
+        pass
+
+    def reset(self):
+        pass
+
+    def startExporter(self, filename, interval=10.0, format='json'):
+        raise ValueError("Instrumentation is disabled")
+
+    def stopExporter(self):
+        pass
+
+NULL_INSTRUMENTATION = NullInstrumentation()
@@ -0,0 +1,135 @@
+# Resumable dataset jobs: a JSON config describes the whole dataset, which is
+# generated in shards of consecutive plates, one folder per shard. A shard is
+# committed once it is recorded in output/manifest.json with its plates, seed
+# and character statistics, folders missing from the manifest are incomplete.
+# A job that dies is resumed after the last committed shard and produces the
+# same files as a job that never stopped, as plate i only depends on the seed
+# and the statistics before it.
+#
+# $ python jobRunner.py job.json
+#
+# {
+#     "output":      "datasets/mercosul",
+#     "numOfPlates": 2000000,
+#     "shardSize":   50000,
+#     "seed":        1234,
+#     "generator":   {"isMercosul": true},
+#     "dataset":     {"model": 0, "augmentation": true, "bgInsertion": true, "encodeWorkers": 4,
+#                     "splitRatios": {"train": 0.8, "val": 0.1, "test": 0.1}}
+# }
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+from datasetCreator import DatasetCreator
+
+MANIFEST = "manifest.json"
+
+# Dataset options set by the runner itself
+RESERVED_OPTIONS = ("numOfPlates", "seed", "outputPath", "realData", "showPlates", "showStatistics", "generatorOptions",
+                    "firstPlate", "statistics", "statsFile")
+
+# Generator options DatasetCreator sets from its own, set them in the dataset section
+# (augmentation, bgInsertion, contourOnly, balanceData for balanceCharacters)
+RESERVED_GENERATOR_OPTIONS = ("showPlates", "augmentation", "bgInsertion", "contourOnly", "balanceCharacters",
+                              "instrumentation", "arrayOutput")
+
+class JobRunner:
+    def __init__(self, config):
+        self.config      = config
+        self.output      = config["output"]
+        self.numOfPlates = int(config["numOfPlates"])
+        self.shardSize   = int(config.get("shardSize", 10000))
+        self.seed        = int(config.get("seed", 0))
+        self.generator   = config.get("generator", {})
+        self.dataset     = config.get("dataset", {})
+        self.configHash  = hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+        if self.shardSize < 1:
+            raise ValueError("shardSize must be positive")
+        reserved = set(self.dataset) & set(RESERVED_OPTIONS)
+        if reserved:
+            raise ValueError("Dataset options set by the job runner: %s" % ", ".join(sorted(reserved)))
+        reserved = set(self.generator) & set(RESERVED_GENERATOR_OPTIONS)
+        if reserved:
+            raise ValueError("Generator options set from the dataset section: %s" % ", ".join(sorted(reserved)))
+
+    @classmethod
+    def fromFile(cls, configFile):
+        with open(configFile) as file:
+            return cls(json.load(file))
+
+    @property
+    def numOfShards(self):
+        return -(-self.numOfPlates // self.shardSize)
+
+    def shardName(self, shard):
+        return "shard-%05d-of-%05d" % (shard, self.numOfShards)
+
+    def loadManifest(self):
+        # A manifest of another config is never resumed, the output folder would mix two datasets
+        manifestFile = os.path.join(self.output, MANIFEST)
+        if not os.path.isfile(manifestFile):
+            return {"configHash": self.configHash, "config": self.config, "shards": []}
+        with open(manifestFile) as file:
+            manifest = json.load(file)
+        if manifest["configHash"] != self.configHash:
+            raise ValueError("%s was written by another job config" % manifestFile)
+        return manifest
+
+    def saveManifest(self, manifest):
+        manifestFile = os.path.join(self.output, MANIFEST)
+        tmpFile      = manifestFile + ".tmp"
+        with open(tmpFile, "w") as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(tmpFile, manifestFile)
+
+    def run(self):
+        os.makedirs(self.output, exist_ok=True)
+        manifest   = self.loadManifest()
+        done       = len(manifest["shards"])
+        statistics = manifest["shards"][-1]["statistics"] if done else None
+        if done:
+            print("Resuming %s from shard %d of %d" % (self.output, done, self.numOfShards))
+
+        for shard in range(done, self.numOfShards):
+            entry      = self.runShard(shard, statistics)
+            statistics = entry["statistics"]
+            manifest["shards"].append(entry)
+            self.saveManifest(manifest)
+        print("Job %s complete, %d plates in %d shards" % (self.output, self.numOfPlates, self.numOfShards))
+        return manifest
+
+    def runShard(self, shard, statistics):
+        # Leftovers of a shard that did not make it into the manifest are written again.
+        # Files are written in place, YOLO image lists hold their final paths
+        folder      = os.path.join(self.output, self.shardName(shard))
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+
+        firstPlate  = shard * self.shardSize
+        numOfPlates = min(self.shardSize, self.numOfPlates - firstPlate)
+        startTime   = time.time()
+        creator     = DatasetCreator(numOfPlates, seed=self.seed, outputPath=os.path.join(folder, "plates"),
+                                     generatorOptions=self.generator, firstPlate=firstPlate, statistics=statistics,
+                                     statsFile=os.path.join(folder, "stats.json"), showPlates=False, **self.dataset)
+
+        return {"shard":          shard,
+                "folder":         self.shardName(shard),
+                "firstPlate":     firstPlate,
+                "numOfPlates":    numOfPlates,
+                "seed":           self.seed,
+                "files":          sorted(os.path.relpath(os.path.join(root, name), folder)
+                                         for root, _, names in os.walk(folder) for name in names),
+                "statistics":     dict(creator.statistics),
+                "counters":       creator.getStats()["counters"],
+                "elapsedSeconds": round(time.time() - startTime, 3)}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python jobRunner.py job.json")
+        sys.exit(1)
+    JobRunner.fromFile(sys.argv[1]).run()
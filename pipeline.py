@@ -0,0 +1,126 @@
+# Staged pipeline: every stage runs in its own worker threads and stages are
+# connected by bounded queues, so a slow stage makes the previous ones wait
+# (backpressure) instead of piling up work, and the slowest stage sets the
+# throughput. Items leave the pipeline in the order they entered it.
+import queue
+import threading
+
+# End of the items, sent once to every worker of a stage
+_DONE = object()
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class Stage:
+    def __init__(self, name, function, workers=1):
+        # function(item) -> item, called from workers threads at once
+        if workers < 1:
+            raise ValueError("Stage %s needs at least one worker" % name)
+        self.name     = name
+        self.function = function
+        self.workers  = workers
+
+
+class Pipeline:
+    def __init__(self, stages, queueSize=4):
+        # queueSize: items waiting between two stages
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+        self.stages    = list(stages)
+        self.queueSize = queueSize
+
+    def run(self, items):
+        # Generator of the results of the last stage, in the order of items
+        queues  = [queue.Queue(self.queueSize) for _ in self.stages] + [queue.Queue()]
+        stop    = threading.Event()
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0], queues[-1], self.stages[0].workers, stop),
+                                    name="pipeline-feed", daemon=True)]
+        for stageIdx, stage in enumerate(self.stages):
+            nextWorkers = self.stages[stageIdx + 1].workers if stageIdx + 1 < len(self.stages) else 1
+            remaining   = [stage.workers]
+            lock        = threading.Lock()
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(target=self._work,
+                                                args=(stage, queues[stageIdx], queues[stageIdx + 1], queues[-1],
+                                                      nextWorkers, remaining, lock, stop),
+                                                name="pipeline-%s-%d" % (stage.name, worker), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        # Reorder buffer, results wait there until every earlier item is out
+        try:
+            waiting = {}
+            nextSeq = 0
+            while True:
+                result = queues[-1].get()
+                if result is _DONE:
+                    break
+                seq, item = result
+                if isinstance(item, _Failure):
+                    raise item.error
+                waiting[seq] = item
+                while nextSeq in waiting:
+                    yield waiting.pop(nextSeq)
+                    nextSeq += 1
+        finally:
+            # Also reached when the caller stops early, blocked workers notice stop and leave
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    @staticmethod
+    def _put(outQueue, item, stop):
+        while not stop.is_set():
+            try:
+                outQueue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def _get(inQueue, stop):
+        while not stop.is_set():
+            try:
+                return inQueue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _feed(self, items, outQueue, resultQueue, workers, stop):
+        try:
+            for seq, item in enumerate(items):
+                if not self._put(outQueue, (seq, item), stop):
+                    return
+        except Exception as error:
+            self._put(resultQueue, (None, _Failure(error)), stop)
+            return
+        for _ in range(workers):
+            if not self._put(outQueue, _DONE, stop):
+                return
+
+    def _work(self, stage, inQueue, outQueue, resultQueue, nextWorkers, remaining, lock, stop):
+        while True:
+            task = self._get(inQueue, stop)
+            if task is _DONE:
+                break
+            seq, item = task
+            try:
+                item = stage.function(item)
+            except Exception as error:
+                # Goes straight to the caller, which raises it and stops everything
+                self._put(resultQueue, (seq, _Failure(error)), stop)
+                return
+            if not self._put(outQueue, (seq, item), stop):
+                return
+
+        # The last worker of the stage to leave tells the next stage, every item is already queued then
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(nextWorkers):
+                if not self._put(outQueue, _DONE, stop):
+                    return
@@ -0,0 +1,105 @@
+# Plate compositing on uint8 NumPy canvases. Glyphs are pre-decoded once into
+# blend-ready arrays and alpha blended into the canvas with integer math that
+# matches PIL's Image.paste(glyph, pos, glyph) bit for bit.
+import sys
+import numpy as np
+
+# Byte holding bits 16-23 of a uint32, the blended value ends up there
+_BLEND_BYTE = 2 if sys.byteorder == 'little' else 1
+
+class Glyph:
+    # Only the bounding box of the visible pixels is blended. Scratch buffers make
+    # a glyph usable by one thread at a time, like the generator owning it.
+    __slots__ = ('width', 'height', 'left', 'top', 'premultiplied', 'inverseAlpha', 'scratch')
+
+    def __init__(self, rgba):
+        rgba        = np.asarray(rgba, dtype=np.uint8)
+        self.height = rgba.shape[0]
+        self.width  = rgba.shape[1]
+        rows        = np.flatnonzero(rgba[..., 3].any(axis=1))
+        cols        = np.flatnonzero(rgba[..., 3].any(axis=0))
+        if len(rows) == 0:
+            rows = cols = np.zeros(1, dtype=np.intp)
+            rgba = np.zeros((1, 1, 4), dtype=np.uint8)
+        self.top, self.left = int(rows[0]), int(cols[0])
+        visible     = rgba[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+
+        # Both terms are scaled by 257, see PlateCompositor.blend
+        alpha              = visible[..., 3:4].astype(np.uint32)
+        self.premultiplied = (visible[..., :3].astype(np.uint32) * alpha + 128) * 257
+        self.inverseAlpha  = np.repeat((255 - alpha) * 257, 3, axis=2)
+        self.scratch       = np.empty(self.premultiplied.shape, dtype=np.uint32)
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    def copy(self):
+        # Shares the blend arrays, only the scratch buffer is new, for another thread
+        glyph = Glyph.__new__(Glyph)
+        for name in Glyph.__slots__:
+            setattr(glyph, name, getattr(self, name))
+        glyph.scratch = np.empty_like(self.scratch)
+        return glyph
+
+
+class PlateCompositor:
+    def __init__(self, template, atlas):
+        # template: PIL image of the empty plate
+        self.template = np.ascontiguousarray(np.asarray(template.convert("RGB")))
+        self.atlas    = atlas
+        self.glyphs   = {}
+
+    def canvases(self, num):
+        # One allocation for a whole batch, canvases[i] is a plate
+        canvases      = np.empty((num,) + self.template.shape, dtype=np.uint8)
+        canvases[...] = self.template
+        return canvases
+
+    def glyph(self, kind, char):
+        key = (kind, char)
+        if key not in self.glyphs:
+            if kind == "letter":
+                image = self.atlas.letter(char)
+            else:
+                image = self.atlas.number(char)
+            self.glyphs[key] = Glyph(np.asarray(image.convert("RGBA")))
+        return self.glyphs[key]
+
+    def letter(self, char):
+        return self.glyph("letter", char)
+
+    def number(self, char):
+        return self.glyph("number", char)
+
+    @staticmethod
+    def blend(canvas, glyph, x, y):
+        # Glyphs crossing the canvas border are clipped, like PIL does
+        canvasH, canvasW = canvas.shape[:2]
+        visibleH, visibleW = glyph.premultiplied.shape[:2]
+        x, y   = x + glyph.left, y + glyph.top
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + visibleW, canvasW), min(y + visibleH, canvasH)
+        if x0 >= x1 or y0 >= y1:
+            return canvas
+        region  = canvas[y0:y1, x0:x1]
+        window  = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+        scratch = glyph.scratch[window]
+
+        # PIL rounds v = canvas * (255 - alpha) + glyph * alpha with
+        # (v + 128 + ((v + 128) >> 8)) >> 8, which is ((v + 128) * 257) >> 16
+        np.multiply(region, glyph.inverseAlpha[window], out=scratch)
+        scratch += glyph.premultiplied[window]
+        np.copyto(region, scratch.view(np.uint8)[..., _BLEND_BYTE::4])
+        return canvas
+
+    @staticmethod
+    def paste(canvas, image, x, y):
+        # Opaque paste of an array (e.g. a plate onto a background), clipped to the canvas
+        canvasH, canvasW = canvas.shape[:2]
+        imageH, imageW   = image.shape[:2]
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + imageW, canvasW), min(y + imageH, canvasH)
+        if x0 < x1 and y0 < y1:
+            canvas[y0:y1, x0:x1] = image[y0 - y:y1 - y, x0 - x:x1 - x]
+        return canvas
@@ -3,18 +3,40 @@
 import csv
 
 from PIL import Image, ImageDraw
-from imgaug import augmenters as iaa
 import time
-import matplotlib.pyplot as plt
 import random
 import os
 import sys
+import itertools
 import collections
-import imgaug as ia
+import threading
+import multiprocessing
 import numpy as np
+from glyphAtlas import GlyphAtlas
+from backgroundPool import BackgroundPool
+from plateCompositor import PlateCompositor
+from platePlanner import PlatePlanner, PlateIndex, LETTER, NUMBER, ALPHANUM
+from instrumentation import Instrumentation, NULL_INSTRUMENTATION
+from pipeline import Pipeline, Stage
+import fastAugmenters
+
+# Stages of iterPlates(stageWorkers=...), planning is always done by a single worker, in plate order
+PIPELINE_STAGES = ("compose", "augment", "background")
+
+# Augmentation tiers: 'full' uses imgcorruptlike Fog/Spatter, 'fast' the NumPy look-alikes of
+# fastAugmenters.py and 'light' no weather at all. Everything else is the same in every tier
+AUGMENTATION_PROFILES = ("full", "fast", "light")
+
+def importImgaug():
+    # imgaug (and scipy/scikit-image behind it) takes seconds to import, only augmentation loads it
+    import imgaug
+    from imgaug import augmenters
+    return imgaug, augmenters
 
 class PlateGenerator:
-    def __init__(self, showPlates=True, showStatistics=False, augmentation=True, bgInsertion=False, contourOnly=False, isMercosul=True, isMotorcycle=False, isRed=False):
+    def __init__(self, showPlates=True, showStatistics=False, augmentation=True, bgInsertion=False, contourOnly=False, isMercosul=True, isMotorcycle=False, isRed=False, glyphCache=None,
+                 bgCache=None, bgPoolSize=64, instrumentation=None, arrayOutput=False, balanceCharacters=False,
+                 targetDistribution=None, augmentationProfile='full'):
         self.dataFolder       = 'data/mercosul' if isMercosul else ('data/red' if isRed else 'data')
         self.letters          = ["A", "B", "C", "D", "E", "F", "G",
                                  "H", "I", "J", "K", "L", "M", "N",
@@ -29,7 +51,6 @@ class PlateGenerator:
                                                          ("Z",0), ("0",0), ("1",0), ("2",0), ("3",0),
                                                          ("4",0), ("5",0), ("6",0), ("7",0), ("8",0),
                                                          ("9",0), ("-",0), ("plate",0)])
-        self.bboxes            = []
         self.bgFiles           = []
         self.numbers           = ["0", "1", "2", "3", "4", "5", "6", "7", "8", "9"]
         self.nLetters          = 3
@@ -41,31 +62,23 @@ class PlateGenerator:
                 self.plateSize         = (128, 149)
                 self.initialWidth = 110
                 self.initialHeight = 100
-                self.widthRef = 70
-                self.heightRef = 85
                 self.charPadding = 10
             else:
                 self.plateSize         = (128, 149)
                 self.initialWidth = 50
                 self.initialHeight = 100
-                self.widthRef = 70
-                self.heightRef = 85
                 self.charPadding = 5
         else:
             self.plateSize         = (212, 646)
             if self.isMercosul:
                 self.initialWidth = 70
                 self.initialHeight = 75
-                self.widthRef = 70
-                self.heightRef = 85
                 self.charPadding = 4
             else:
                 self.plateSize         = (40, 108)
                 self.plateSize         = (162, 500)
                 self.initialWidth = 30
                 self.initialHeight = 55
-                self.widthRef = 30
-                self.heightRef = 55
                 self.charPadding = 0
 
         self.resizeBackground  = (800, 600)
@@ -75,118 +88,109 @@ class PlateGenerator:
         self.visualizePlates   = showPlates
         self.bgInsertion       = bgInsertion
         self.augmentation      = augmentation
+        self.arrayOutput       = arrayOutput
         self.bgFolder          = '../images/test-plates/'
         self.showStatistics    = showStatistics
         self.plateSample       = os.path.join(self.dataFolder, 'plate-motorcycle.jpg' if self.isMotorcycle else 'plateSample01.jpg')
         self.plateIm           = Image.open(self.plateSample)
-        self.resetReferences()
+        self.generatorArgs     = dict(showPlates=False, showStatistics=False, augmentation=augmentation,
+                                      bgInsertion=bgInsertion, contourOnly=contourOnly, isMercosul=isMercosul,
+                                      isMotorcycle=isMotorcycle, isRed=isRed, glyphCache=glyphCache, bgCache=bgCache,
+                                      bgPoolSize=bgPoolSize, arrayOutput=arrayOutput, balanceCharacters=balanceCharacters,
+                                      targetDistribution=targetDistribution, augmentationProfile=augmentationProfile)
+        self.atlas             = GlyphAtlas.shared(self.dataFolder, self.letters, self.numbers, isMercosul=self.isMercosul,
+                                                   isMotorcycle=self.isMotorcycle, cacheFile=glyphCache)
+        self.compositor        = PlateCompositor(self.plateIm, self.atlas)
+        self.codeGlyphs        = [self.compositor.letter(char) for char in self.letters] + \
+                                 [self.compositor.number(char) for char in self.numbers]
+        self.planner           = self.buildPlanner()
+        self.balanceCharacters = balanceCharacters
+        self.targetWeights     = self.buildTargetWeights(targetDistribution)
+        if augmentationProfile not in AUGMENTATION_PROFILES:
+            raise ValueError("Unknown augmentation profile %s" % str(augmentationProfile))
+        self.augmentationProfile = augmentationProfile
+        self._augmenter        = None
+        self.instrumentation   = instrumentation if instrumentation is not None else NULL_INSTRUMENTATION
 
         # get possible background images
         for root, dirs, files in os.walk(self.bgFolder):
             for name in files:
                 self.bgFiles.append(os.path.join(root, name))
+        self.bgFiles.sort()
 
+        # decoded and resized backgrounds
+        self.bgPool = None
+        if self.bgInsertion:
+            self.bgPool = BackgroundPool(self.bgFiles, self.resizeBackground, maxSize=bgPoolSize, cacheFile=bgCache)
 
-    def resetReferences(self):
-        self.widthRef  = self.initialWidth
-        self.heightRef = self.initialHeight
-        self.bboxes    = []
 
-    def generateLetters(self, image, quantity=None):
-        # Adding letters
-        if quantity is None:
-            quantity = self.nLetters
-        for _ in range(0, quantity):
-            randomChar = random.choice(self.letters)
-            file = randomChar
-
-            if not self.isMercosul:
-                if randomChar == "I":
-                    file = "I1"
-
-                if randomChar == "O":
-                    file = "O0"
-
-            char = Image.open(os.path.join(self.dataFolder, "%s.png" % str(file)))
-            padding = self.charPadding
-            if self.isMercosul:
-                char = char.resize((70,110))
-            if self.isMotorcycle and not self.isMercosul:
-                char = char.resize((90,130))
-                padding = int(padding * 6.5)
-
-            charW, charH = char.size
-
-            annotations = self.generateBox(charW, charH, str(randomChar))
-            if not self.contourOnly:
-                # Append box according to widthRef + charW
-                self.bboxes.append(annotations)
-
-            image.paste(char, (self.widthRef, self.heightRef), char)
-            self.widthRef += charW + padding
-
-            # Increment statistics
-            self.statistics[randomChar] +=1
-        return image
-
-    def generateBox(self, charW, charH, tag):
-        xMin = self.widthRef
-        yMin = self.heightRef
-        xMax = self.widthRef + charW + self.charPadding
-        yMax = self.heightRef + charH
-        return xMin,yMin, xMax, yMax, tag
-
-    def generateNumbers(self, image, quantity=None):
-        # Adding numbers
-        if quantity is None:
-            quantity = self.nNumbers
-        for _ in range(0, quantity):
-            randomNum = random.choice(self.numbers)
-            file = randomNum
-            if not self.isMercosul:
-                if randomNum == "1":
-                    file = "I1"
-
-                if randomNum == "0":
-                    file = "O0"
-
-            number = Image.open(os.path.join(self.dataFolder, "%s.png" % str(file)))
-            if self.isMercosul:
-                number = number.resize((70,110))
-
-            if self.isMotorcycle and not self.isMercosul:
-                number = number.resize((80, 120))
-            numberW, numberH = number.size
-
-            annotations = self.generateBox(numberW, numberH, randomNum)
-            if not self.contourOnly:
-                # Append box according to widthRef + numberW
-                self.bboxes.append(annotations)
-
-            image.paste(number, (self.widthRef, self.heightRef), number)
-            self.widthRef += numberW + self.charPadding
-
-            # Increment statistics
-            self.statistics[str(randomNum)] +=1
-        return image
-
-    def generateDash(self, image, includeDash):
-        # Adding dash
-        dash = Image.open(os.path.join(self.dataFolder, "%s.png" % str("-")))
-        dashW, dashH = dash.size
-
-        if includeDash and not self.contourOnly:
-            # Append box according to widthRef + numberW
-            self.bboxes.append(self.generateBox(dashW, dashH, "-"))
-
-        image.paste(dash, (self.widthRef, self.heightRef), dash)
-        self.widthRef += dashW + self.charPadding
-
-        # Increment statistics
-        self.statistics["-"] += 1
-        return image
+    def buildPlanner(self):
+        # Slot geometry of the variant, motorcycle plates continue on a second line after the letters
+        if self.isMercosul:
+            slotKinds = [LETTER] * 3 + [NUMBER, ALPHANUM, NUMBER, NUMBER]
+        else:
+            slotKinds = [LETTER] * self.nLetters + [NUMBER] * self.nNumbers
+        lines = [(0, self.initialWidth, self.initialHeight)]
+        if self.isMotorcycle:
+            lines.append((3, 80 if self.isMercosul else 50, self.initialHeight + 130))
+
+        letterPadding = self.charPadding
+        if self.isMotorcycle and not self.isMercosul:
+            letterPadding = int(letterPadding * 6.5)
+        return PlatePlanner(self.letters, self.numbers, [glyph.size for glyph in self.codeGlyphs], slotKinds, lines,
+                            letterPadding=letterPadding, numberPadding=self.charPadding, boxPadding=self.charPadding)
+
+    def buildTargetWeights(self, targetDistribution):
+        # targetDistribution: {char: weight}, missing characters are never drawn. Uniform when None
+        if targetDistribution is None:
+            return np.ones(len(self.planner.alphabet))
+        weights = np.array([float(targetDistribution.get(char, 0)) for char in self.planner.alphabet])
+        if (weights < 0).any():
+            raise ValueError("Target distribution weights must not be negative")
+        if weights[:len(self.letters)].sum() <= 0 or weights[len(self.letters):].sum() <= 0:
+            raise ValueError("Target distribution needs at least one letter and one number")
+        return weights
+
+    def planPlates(self, indices, seed=None, unique=False):
+        # Unseeded plans draw their seed from the global random state
+        if seed is None:
+            seed = random.getrandbits(64)
+        weights = None
+        if unique:
+            # Unique plates walk a seeded permutation of the plate string space instead
+            plan = self.planner.planUnique(indices, seed)
+        else:
+            if self.balanceCharacters:
+                # Online balancing, characters behind their target share are drawn more often
+                counts  = [self.statistics[char] for char in self.planner.alphabet]
+                weights = self.planner.deficitWeights(counts, self.targetWeights, len(indices))
+            plan = self.planner.plan(indices, seed, weights)
+        for char, count in zip(self.planner.alphabet, self.planner.counts(plan).tolist()):
+            self.statistics[char] += count
+        return plan
+
+    def renderPlan(self, plan, codeGlyphs=None):
+        # Returns (img, boxes) per plate, every canvas of the batch comes from a single allocation.
+        # Threads rendering at the same time need their own codeGlyphs, see Glyph.copy
+        codeGlyphs     = codeGlyphs if codeGlyphs is not None else self.codeGlyphs
+        canvases       = self.compositor.canvases(len(plan["codes"]))
+        plateH, plateW = canvases.shape[1:3]
+        alphabet       = self.planner.alphabet
+        composed       = []
+        for canvas, codes, xMins, yMins, xMaxs, yMaxs in zip(canvases, plan["codes"].tolist(), plan["xMins"].tolist(),
+                                                             plan["yMins"].tolist(), plan["xMaxs"].tolist(),
+                                                             plan["yMaxs"].tolist()):
+            boxes = [(0, 0, plateW, plateH, "plate")]
+            for code, xMin, yMin, xMax, yMax in zip(codes, xMins, yMins, xMaxs, yMaxs):
+                self.compositor.blend(canvas, codeGlyphs[code], xMin, yMin)
+                if not self.contourOnly:
+                    boxes.append((xMin, yMin, xMax, yMax, alphabet[code]))
+            composed.append((canvas, boxes))
+        return composed
 
     def visualizePlate(self, image, bboxes):
+        import matplotlib.pyplot as plt
+        image = self.toImage(image)
         draw = ImageDraw.Draw(image)
         for box in bboxes:
             draw.rectangle([(box[0], box[1]), (box[2], box[3])], None, (0,255,0))
@@ -195,68 +199,16 @@ class PlateGenerator:
         plt.show()
 
 
-    def generatePlates(self, numOfPlates, trainSet=True, includeDash=False, resize=True):
+    def generatePlates(self, numOfPlates, trainSet=True, includeDash=False, resize=True, workers=1, seed=None,
+                       batchSize=1, augmentationWorkers=0, unique=False, exclude=None):
+        # includeDash is a no-op, see iterPlates
         print("------------------------------------------------------------------")
         print("Generating Artificial Data...")
         startTime = time.time()
-        plates    = []
-        for idx in range(0, numOfPlates):
-            plateSample   = self.generatePlateBackground()
-            if self.isMercosul:
-                finalImg             = self.generateLetters(plateSample, 3)
-                if self.isMotorcycle:
-                    self.nextLine()
-                finalImg             = self.generateNumbers(finalImg, 1)
-                if random.randint(0,1) == 1:
-                    finalImg             = self.generateLetters(finalImg, 1)
-                else:
-                    finalImg             = self.generateNumbers(finalImg, 1)
-                finalImg             = self.generateNumbers(finalImg, 2)
-            else:
-                finalImg             = self.generateLetters(plateSample)
-                if self.isMotorcycle:
-                    self.nextLine()
-                # finalImg             = self.generateDash(finalImg, includeDash)
-                finalImg             = self.generateNumbers(finalImg)
-
-            # Perform data augmentation
-            if self.augmentation:
-                img, boxes = self.augmentImg({"plateImg": finalImg, "plateBoxes": self.bboxes}, resize=resize)
-            else:
-                img = finalImg
-                boxes = self.bboxes
-
-            if self.bgInsertion:
-                augBoxes = []
-
-                backgroundFile = random.choice(self.bgFiles)
-                bgImg = Image.open(backgroundFile)
-                bgImg = bgImg.resize(self.resizeBackground, Image.ANTIALIAS)
-
-                bgW, bgH = bgImg.size
-                plateW, plateH = img.size
-                offset = (int((bgW - plateW) * random.uniform(0.1, 1.0)), int((bgH - plateH) * random.uniform(0.1, 1.0)))
-
-                if self.centerPlate:
-                    offset = ((bgW - plateW) // 2, (bgH - plateH) // 2)
-
-                for box in boxes:
-                    cls  = box[4]
-
-                    xMin = box[0] + offset[0]
-                    yMin = box[1] + offset[1]
-                    xMax = box[2] + offset[0]
-                    yMax = box[3] + offset[1]
-                    augBoxes.append((xMin, yMin, xMax, yMax, cls))
-                boxes = augBoxes
-                bgImg.paste(img, offset)
-                img = bgImg
-            if self.visualizePlates:
-                self.visualizePlate(img, boxes)
 
-            plates.append({"plateIdx": idx, "plateImg": img, "plateBoxes": boxes})
-            # Reset references (width, height and boxes)
-            self.resetReferences()
+        plates    = list(self.iterPlates(numOfPlates, includeDash=includeDash, resize=resize, workers=workers, seed=seed,
+                                         batchSize=batchSize, augmentationWorkers=augmentationWorkers, unique=unique,
+                                         exclude=exclude))
 
         # Show histogram
         if self.showStatistics:
@@ -267,35 +219,318 @@ class PlateGenerator:
         print("Plates generated succesfully in %s seconds" % str(elapsed))
         return plates
 
-    def generatePlateBackground(self):
-        plateSample = self.plateIm.copy()
-        plateW, plateH = plateSample.size
-        xMin = 0
-        yMin = 0
-        xMax = plateW
-        yMax = plateH
-        self.bboxes.append((xMin, yMin, xMax, yMax, "plate"))
-        return plateSample
+    def iterPlates(self, numOfPlates, includeDash=False, resize=True, workers=1, seed=None, batchSize=1, augmentationWorkers=0,
+                   unique=False, exclude=None, stageWorkers=None, queueSize=4, firstIndex=0):
+        # Lazily yields one plate dict at a time, so memory does not grow with numOfPlates
+        # includeDash: no-op, kept for compatibility, plates are never drawn with a dash
+        # unique: no plate string is repeated, and none of exclude (a PlateIndex) is rendered
+        # stageWorkers: {"compose": 1, "augment": 4, "background": 2} threads per stage, see iterPlatesPipelined
+        # firstIndex: plates firstIndex... firstIndex + numOfPlates - 1 of the seed, e.g. one shard of a larger job
+        # augmentationWorkers: seeded runs repeat exactly, but the augmentation differs from a run without them
+        if workers > 1 and stageWorkers is not None:
+            raise ValueError("Use either worker processes or pipeline stage workers")
+        if seed is None and (workers > 1 or unique or stageWorkers is not None):
+            # Parallel runs are always seeded, so they match a serial run with the same seed.
+            # Unique runs need one seed for the whole permutation
+            seed = random.randrange(2 ** 32)
+        indices = self.plateIndices(numOfPlates, seed, unique, exclude, firstIndex=firstIndex)
+
+        if stageWorkers is not None:
+            for plate in self.iterPlatesPipelined(indices, stageWorkers, queueSize=queueSize, resize=resize, seed=seed,
+                                                  batchSize=batchSize, unique=unique):
+                yield plate
+            return
+
+        if workers > 1:
+            for plate in self.iterPlatesParallel(indices, numOfPlates, workers, resize=resize, seed=seed,
+                                                 batchSize=batchSize, unique=unique):
+                yield plate
+            return
+
+        pool = self.augmenterPool(augmentationWorkers, seed=seed) if self.augmentation and augmentationWorkers > 0 else None
+        try:
+            for batch in self.batches(indices, batchSize):
+                for plate in self.generateBatch(batch, resize=resize, seed=seed, pool=pool,
+                                                unique=unique):
+                    yield plate
+        finally:
+            if pool is not None:
+                pool.close()
+
+    def plateIndices(self, numOfPlates, seed, unique=False, exclude=None, blockSize=4096, firstIndex=0):
+        # Plate indices to render. With exclude, unique runs skip the permutation positions whose
+        # string is already in the index, before anything is rendered, and mark the new ones
+        if not unique:
+            return range(firstIndex, firstIndex + numOfPlates)
+        if exclude is not None and firstIndex != 0:
+            raise ValueError("Plates excluded from a unique run are skipped from the first plate on")
+        available = self.planner.spaceSize - (len(exclude) if exclude is not None else firstIndex)
+        if numOfPlates > available:
+            raise ValueError("Only %d different plates are left" % available)
+        if exclude is None:
+            return range(firstIndex, firstIndex + numOfPlates)
+        return self.iterNewIndices(numOfPlates, seed, exclude, blockSize)
+
+    def iterNewIndices(self, numOfPlates, seed, exclude, blockSize):
+        remaining = numOfPlates
+        for start in range(0, self.planner.spaceSize, blockSize):
+            positions = np.arange(start, min(start + blockSize, self.planner.spaceSize))
+            ranks     = self.planner.permute(positions, seed)
+            isNew     = ~exclude.contains(ranks)
+            positions = positions[isNew][:remaining]
+            exclude.add(ranks[isNew][:remaining])
+            for idx in positions.tolist():
+                yield idx
+            remaining -= len(positions)
+            if remaining == 0:
+                return
+
+    def plateIndex(self):
+        # Empty bitmap over the plate strings of this variant
+        return PlateIndex(self.planner.spaceSize)
+
+    @staticmethod
+    def batches(indices, batchSize):
+        indices = iter(indices)
+        while True:
+            batch = list(itertools.islice(indices, batchSize))
+            if not batch:
+                return
+            yield batch
+
+    generatePlatesStream = iterPlates
+
+    def iterPlatesParallel(self, indices, numOfPlates, workers, resize=True, seed=None, batchSize=1,
+                           unique=False):
+        # Chunks hold whole batches, so batches start at the same indices as in a serial run.
+        # Batches are planned here as their chunk is submitted, in plate order, so balancing sees
+        # every plate before them. Workers only render them
+        chunkSize = max(1, min(64, numOfPlates // (workers * 4)))
+        chunkSize = -(-chunkSize // batchSize) * batchSize
+        chunks    = (([self.planBatch(batch, seed=seed, unique=unique) for batch in self.batches(chunk, batchSize)], resize)
+                     for chunk in self.batches(indices, chunkSize))
+
+        initArgs  = (self.generatorArgs, self.instrumentation.enabled)
+        with multiprocessing.Pool(workers, initializer=_initWorker, initargs=initArgs) as pool:
+            # Only a couple of chunks per worker are in flight, results are consumed in plate index order
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_generateChunk, (chunk,)))
+                if len(pending) >= workers * 2:
+                    for plate in self.mergeChunk(*pending.popleft().get()):
+                        yield plate
+            while pending:
+                for plate in self.mergeChunk(*pending.popleft().get()):
+                    yield plate
+
+    def mergeChunk(self, chunkPlates, chunkStats):
+        # Stage timers of the workers add up, they are CPU seconds rather than wall time
+        self.instrumentation.merge(chunkStats)
+        if self.visualizePlates:
+            for plate in chunkPlates:
+                self.visualizePlate(plate["plateImg"], plate["plateBoxes"])
+        return chunkPlates
+
+    @staticmethod
+    def plateSeeds(seed, idx):
+        # Independent seeds for the python sampling and the augmentation of a single plate
+        rngSeed, augSeed = np.random.SeedSequence([seed, idx]).generate_state(2)
+        return int(rngSeed), int(augSeed)
+
+    def plateRandom(self, idx, seed=None):
+        if seed is None:
+            return random, None
+        rngSeed, augSeed = self.plateSeeds(seed, idx)
+        return random.Random(rngSeed), augSeed
+
+    def generatePlate(self, idx, resize=True, seed=None):
+        return self.generateBatch([idx], resize=resize, seed=seed)[0]
+
+    def iterPlatesPipelined(self, indices, stageWorkers, queueSize=4, resize=True, seed=None, batchSize=1, unique=False):
+        # Batches flow plan -> compose -> augment -> background through bounded queues, every stage in
+        # its own threads, plates match a serial run with the same seed and batchSize. Compose and augment
+        # threads own their glyph scratch buffers and augmenter. imgcorruptlike augmenters seed the global
+        # NumPy state, so with the 'full' profile several augment workers hand their batches to as many processes
+        unknown = set(stageWorkers) - set(PIPELINE_STAGES)
+        if unknown:
+            raise ValueError("Unknown pipeline stages %s" % ", ".join(sorted(unknown)))
+        local          = threading.local()
+        augmentWorkers = stageWorkers.get("augment", 1)
+        pool           = None
+        if self.augmentation and augmentWorkers > 1 and self.augmentationProfile == 'full':
+            pool = multiprocessing.Pool(augmentWorkers, initializer=_initWorker,
+                                        initargs=(self.generatorArgs, self.instrumentation.enabled))
+
+        def compose(batch):
+            if not hasattr(local, "codeGlyphs"):
+                local.codeGlyphs = [glyph.copy() for glyph in self.codeGlyphs]
+            return self.composeBatch(batch, local.codeGlyphs)
+
+        def augment(batch):
+            if pool is None:
+                if not hasattr(local, "augmenter"):
+                    local.augmenter = self.augmenter.deepcopy() if augmentWorkers > 1 else self.augmenter
+                return self.augmentPlanned(batch, resize=resize, augmenter=local.augmenter)
+            # The plate randoms come back too, backgrounds go on drawing from them
+            batch["composed"], batch["randoms"], stats = pool.apply(_augmentComposed, (batch["composed"], batch["randoms"], resize))
+            self.instrumentation.merge(stats)
+            return batch
+
+        stages = [Stage("plan", lambda indices: self.planBatch(indices, seed=seed, unique=unique)),
+                  Stage("compose", compose, stageWorkers.get("compose", 1))]
+        if self.augmentation:
+            stages.append(Stage("augment", augment, augmentWorkers))
+        if self.bgInsertion:
+            stages.append(Stage("background", self.backgroundBatch, stageWorkers.get("background", 1)))
+
+        batches = Pipeline(stages, queueSize=queueSize).run(self.batches(indices, batchSize))
+        try:
+            for batch in batches:
+                for plate in self.finishBatch(batch):
+                    yield plate
+        finally:
+            batches.close()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def generateBatch(self, indices, resize=True, seed=None, pool=None, unique=False):
+        return self.renderBatch(self.planBatch(indices, seed=seed, unique=unique), resize=resize, pool=pool)
+
+    def renderBatch(self, batch, resize=True, pool=None):
+        batch = self.composeBatch(batch)
+        if self.augmentation:
+            batch = self.augmentPlanned(batch, resize=resize, pool=pool)
+        if self.bgInsertion:
+            batch = self.backgroundBatch(batch)
+        return self.finishBatch(batch)
+
+    # Stages of a batch, a dict that goes from plan to plates. Planning updates the statistics,
+    # so batches are planned one at a time and in order
+
+    def planBatch(self, indices, seed=None, unique=False):
+        return {"indices": indices,
+                "randoms": [self.plateRandom(idx, seed) for idx in indices],
+                "plan":    self.planPlates(indices, seed, unique=unique)}
+
+    def composeBatch(self, batch, codeGlyphs=None):
+        with self.instrumentation.timer("compose"):
+            batch["composed"] = self.renderPlan(batch.pop("plan"), codeGlyphs)
+        return batch
+
+    def augmentPlanned(self, batch, resize=True, pool=None, augmenter=None):
+        # A batch is augmented with the seed of its first plate
+        randoms = batch["randoms"]
+        with self.instrumentation.timer("augment"):
+            batch["composed"] = self.augmentBatch([{"plateImg": img, "plateBoxes": boxes} for img, boxes in batch["composed"]],
+                                                  resize=resize, rngs=[rng for rng, _ in randoms], seed=randoms[0][1],
+                                                  pool=pool, augmenter=augmenter)
+        return batch
+
+    def backgroundBatch(self, batch):
+        composed = []
+        for (rng, _), (img, boxes) in zip(batch["randoms"], batch["composed"]):
+            with self.instrumentation.timer("background"):
+                composed.append(self.insertBackground(img, boxes, rng=rng))
+        batch["composed"] = composed
+        return batch
+
+    def finishBatch(self, batch):
+        plates = []
+        for idx, (img, boxes) in zip(batch["indices"], batch["composed"]):
+            if self.visualizePlates:
+                self.visualizePlate(img, boxes)
+            if not self.arrayOutput:
+                img = self.toImage(img)
+            plates.append({"plateIdx": idx, "plateImg": img, "plateBoxes": boxes})
+
+        if self.instrumentation.enabled:
+            self.instrumentation.count("platesRendered", len(plates))
+            self.instrumentation.count("boxesEmitted", sum(len(plate["plateBoxes"]) for plate in plates))
+        return plates
+
+    def composePlate(self, rng=random):
+        # A single plate, planned with a seed drawn from rng
+        return self.renderPlan(self.planPlates([0], seed=rng.getrandbits(64)))[0]
+
+    def insertBackground(self, img, boxes, rng=random):
+        augBoxes = []
+
+        bgImg = self.bgPool.choiceArray(rng)
+
+        bgH, bgW = bgImg.shape[:2]
+        plateH, plateW = img.shape[:2]
+        offset = (int((bgW - plateW) * rng.uniform(0.1, 1.0)), int((bgH - plateH) * rng.uniform(0.1, 1.0)))
+
+        if self.centerPlate:
+            offset = ((bgW - plateW) // 2, (bgH - plateH) // 2)
+
+        for box in boxes:
+            cls  = box[4]
+
+            xMin = box[0] + offset[0]
+            yMin = box[1] + offset[1]
+            xMax = box[2] + offset[0]
+            yMax = box[3] + offset[1]
+            augBoxes.append((xMin, yMin, xMax, yMax, cls))
+        PlateCompositor.paste(bgImg, img, offset[0], offset[1])
+        return bgImg, augBoxes
 
     def visualizeStatistics(self):
+        import matplotlib.pyplot as plt
         plt.figure()
         plt.title("Characters Histogram")
         plt.bar(self.statistics.keys(), self.statistics.values(), 1, color='g')
         plt.show()
 
-    def augmentImg(self, plate, resize=False):
-        # for plate in plates:
+    @property
+    def augmenter(self):
+        # Built on first use, generators without augmentation never import imgaug
+        if self._augmenter is None:
+            self._augmenter = self.buildAugmenter()
+        return self._augmenter
+
+    def buildAugmenter(self):
+        # OneOf children are wrapped in a list, otherwise seed_() skips them
+        _, iaa = importImgaug()
+        weather = []
+        if self.augmentationProfile == 'full':
+            weather = [iaa.Sometimes(0.9, [iaa.OneOf([iaa.imgcorruptlike.Fog(severity=2), iaa.imgcorruptlike.Spatter(severity=2)])])]
+        elif self.augmentationProfile == 'fast':
+            weather = [iaa.Sometimes(0.9, [iaa.OneOf([iaa.Lambda(func_images=fastAugmenters.fogImages),
+                                                      iaa.Lambda(func_images=fastAugmenters.spatterImages)])])]
+        return iaa.Sequential([
+            iaa.Sometimes(0.6,
+                          [iaa.OneOf([iaa.GaussianBlur((0, 0.8)) # blur images with a sigma between 0 and 1.0
+                                     # iaa.AverageBlur(k=(1, 3)), # blur image using local means with kernel sizes between 2 and 5
+                                     # iaa.MedianBlur(k=(1, 3)), # blur image using local medians with kernel sizes between 3 and 5
+                                     ])]),
+            iaa.contrast.LinearContrast((0.5, 2.0)),
+            iaa.AdditiveGaussianNoise(loc=0, scale=(0.0, 0.01 * 255), per_channel=0.2),
+            iaa.Multiply((0.8, 1.5), per_channel=0.1),
+            # iaa.Sometimes(0.7, iaa.Clouds(20)),
+            # iaa.Sometimes(0.7, iaa.MultiplyBrightness((1.5, 2.5))),
+            iaa.Sometimes(0.7, iaa.Affine(rotate=(-5, 5), shear=(-8, 8))),
+            iaa.Sometimes(0.7, iaa.Add((-3, 3), per_channel=0.2)),
+            iaa.Sometimes(0.5, iaa.Dropout((0.01, 0.05), per_channel=0.5)),
+            ] + weather + [
+            iaa.Sometimes(0.3, iaa.Affine(shear=(-3, 3)))], random_order=True)
+
+    def augmenterPool(self, processes, seed=None):
+        # imgaug multicore pool, batches are spread over the processes. The pool seeds every
+        # sub-batch from seed and its position in the run, so seeded runs repeat exactly
+        return self.augmenter.pool(processes=processes, seed=seed % 2 ** 31 if seed is not None else None)
+
+    def prepareAugmentation(self, plate, resize=False, rng=random):
+        ia, _       = importImgaug()
         plateImg    = np.asarray(plate['plateImg'])
         plateBoxes  = plate['plateBoxes']
-        bbs         = []
-
-        for box in plateBoxes:
-            bbs.append(ia.BoundingBox(box[0], box[1], box[2], box[3]))
-        bboxAug = ia.BoundingBoxesOnImage(bbs, shape=plateImg.shape)
+        bboxAug     = ia.BoundingBoxesOnImage.from_xyxy_array(np.array([box[:4] for box in plateBoxes], dtype=np.float32),
+                                                              shape=plateImg.shape)
 
         if resize:
             if self.resizePlateFactor == 'random':
-                resizeFactorW = round(random.uniform(0.3, 0.9), 1)
+                resizeFactorW = round(rng.uniform(0.3, 0.9), 1)
 
                 ratio = self.plateSize[0] / self.plateSize[1]
                 newWidth  = resizeFactorW*self.plateSize[0]
@@ -307,47 +542,79 @@ class PlateGenerator:
             plateImg = ia.imresize_single_image(plateImg, plateSize)
             # print(plateSize)
             bboxAug = bboxAug.on(plateImg)
+        return plateImg, bboxAug
+
+    def augmentBatch(self, plates, resize=False, rngs=None, seed=None, pool=None, augmenter=None):
+        # Augments many plates (images plus boxes) with a single call to the pipeline
+        ia, _     = importImgaug()
+        augmenter = augmenter if augmenter is not None else self.augmenter
+        if rngs is None:
+            rngs = [random] * len(plates)
+        prepared = [self.prepareAugmentation(plate, resize=resize, rng=rng) for plate, rng in zip(plates, rngs)]
+        images   = [plateImg for plateImg, _ in prepared]
+        bboxes   = [bboxAug for _, bboxAug in prepared]
+
+        if pool is not None:
+            # One sub-batch per process of the imgaug pool
+            subSize = -(-len(images) // pool.processes)
+            batches = [ia.UnnormalizedBatch(images=images[start:start + subSize], bounding_boxes=bboxes[start:start + subSize])
+                       for start in range(0, len(images), subSize)]
+            batches = pool.map_batches(batches)
+        else:
+            if seed is not None:
+                augmenter.seed_(seed)
+            batches = [augmenter.augment_batch_(ia.UnnormalizedBatch(images=images, bounding_boxes=bboxes))]
 
-        seq    = iaa.Sequential([
-            iaa.Sometimes(0.6,
-                          iaa.OneOf([iaa.GaussianBlur((0, 0.8)) # blur images with a sigma between 0 and 1.0
-                                     # iaa.AverageBlur(k=(1, 3)), # blur image using local means with kernel sizes between 2 and 5
-                                     # iaa.MedianBlur(k=(1, 3)), # blur image using local medians with kernel sizes between 3 and 5
-                                     ])),
-            iaa.contrast.LinearContrast((0.5, 2.0)),
-            iaa.AdditiveGaussianNoise(loc=0, scale=(0.0, 0.01 * 255), per_channel=0.2),
-            iaa.Multiply((0.8, 1.5), per_channel=0.1),
-            # iaa.Sometimes(0.7, iaa.Clouds(20)),
-            # iaa.Sometimes(0.7, iaa.MultiplyBrightness((1.5, 2.5))),
-            iaa.Sometimes(0.7, iaa.Affine(rotate=(-5, 5), shear=(-8, 8))),
-            iaa.Sometimes(0.7, iaa.Add((-3, 3), per_channel=0.2)),
-            iaa.Sometimes(0.5, iaa.Dropout((0.01, 0.05), per_channel=0.5)),
-            iaa.Sometimes(0.9, iaa.OneOf([iaa.imgcorruptlike.Fog(severity=2), iaa.imgcorruptlike.Spatter(severity=2)])),
-            iaa.Sometimes(0.3, iaa.Affine(shear=(-3, 3)))], random_order=True)
-        seq_det = seq.to_deterministic()
-
+        augmented = []
+        for batch in batches:
+            for imageAug, bboxAug in zip(batch.images_aug, batch.bounding_boxes_aug):
+                augmented.append((imageAug, bboxAug))
 
-        imageAug    = seq_det.augment_images([plateImg])[0]
-        bboxAug     = seq_det.augment_bounding_boxes([bboxAug])[0]
         # bboxAug     = bboxAug.remove_out_of_image().cut_out_of_image()
+        results = []
+        for plate, (imageAug, bboxAug) in zip(plates, augmented):
+            bboxAugFormatted = [(x1, y1, x2, y2, box[4]) for (x1, y1, x2, y2), box in zip(bboxAug.to_xyxy_array().tolist(),
+                                                                                          plate['plateBoxes'])]
+            results.append((imageAug, bboxAugFormatted))
+        return results
 
-        bboxAugFormatted = []
-        for idx, box in enumerate(bboxAug.bounding_boxes):
-            bboxAugFormatted.append((box.x1, box.y1, box.x2, box.y2, plateBoxes[idx][4]))
+    def augmentImg(self, plate, resize=False, rng=random, seed=None):
+        return self.augmentBatch([plate], resize=resize, rngs=[rng], seed=seed)[0]
 
-        return Image.fromarray(imageAug), bboxAugFormatted
 
+    @staticmethod
+    def toImage(img):
+        # Plates are arrays until the end of the pipeline
+        if isinstance(img, np.ndarray):
+            return Image.fromarray(img)
+        return img
 
     def getStatistics(self):
         return self.statistics
 
-    def nextLine(self):
-        if self.isMercosul:
-            self.heightRef += 130
-            self.widthRef = 80
-        else:
-            self.heightRef += 130
-            self.widthRef = 50
+# Generator owned by each worker process of iterPlatesParallel
+_workerGenerator = None
+
+def _initWorker(generatorArgs, instrumented=False):
+    global _workerGenerator
+    _workerGenerator = PlateGenerator(instrumentation=Instrumentation() if instrumented else None, **generatorArgs)
+
+def _generateChunk(args):
+    # Renders batches planned by the parent, which already counted their characters
+    batches, resize = args
+    generator = _workerGenerator
+    generator.instrumentation.reset()
+    plates = []
+    for batch in batches:
+        plates.extend(generator.renderBatch(batch, resize=resize))
+    return plates, generator.instrumentation.stats()
+
+def _augmentComposed(composed, randoms, resize):
+    # Augment stage of iterPlatesPipelined
+    generator = _workerGenerator
+    generator.instrumentation.reset()
+    batch     = generator.augmentPlanned({"composed": composed, "randoms": randoms}, resize=resize)
+    return batch["composed"], batch["randoms"], generator.instrumentation.stats()
 
 
 def save_to_csv(file_name, label=False, p1=False, p2=False):
@@ -363,16 +630,20 @@ def save_to_csv(file_name, label=False, p1=False, p2=False):
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
-        numOfPlates = int(sys.argv[1])
-        for _ in range(numOfPlates):
-            plateGen = PlateGenerator(showPlates=False, showStatistics=False, contourOnly=False, isMercosul=False, isMotorcycle=True, isRed=True)
-            plates = plateGen.generatePlates(numOfPlates=1)
-            img = plates[0]['plateImg']
-            plate = [plates[0]['plateBoxes'][i][4] for i in range(1,8)]
-            chars = [plates[0]['plateBoxes'][i] for i in range(1,8)]
-            name = '/home/felipe/Documents/Aiknow/BRLicensePlateGen/generated/red/' + ''.join(plate).lower() + '.jpeg'
-            if os.path.isfile(name):
-                continue
+        numOfPlates  = int(sys.argv[1])
+        outputFolder = sys.argv[2] if len(sys.argv) > 2 else '/home/felipe/Documents/Aiknow/BRLicensePlateGen/generated/red/'
+        plateGen     = PlateGenerator(showPlates=False, showStatistics=False, contourOnly=False, isMercosul=False, isMotorcycle=True, isRed=True)
+
+        # Plates already in the output folder are skipped before rendering
+        existing = plateGen.plateIndex()
+        ranks    = [plateGen.planner.rankOf(os.path.splitext(name)[0]) for name in os.listdir(outputFolder)]
+        existing.add([rank for rank in ranks if rank is not None])
+
+        for plates in plateGen.iterPlates(numOfPlates, unique=True, exclude=existing):
+            img = plates['plateImg']
+            plate = [plates['plateBoxes'][i][4] for i in range(1,8)]
+            chars = [plates['plateBoxes'][i] for i in range(1,8)]
+            name = os.path.join(outputFolder, ''.join(plate).lower() + '.jpeg')
             img.save(name)
             # w = img.width
             # h = img.height
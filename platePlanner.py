@@ -0,0 +1,210 @@
+# Plate planning: a whole batch of plate strings is sampled as an (N, 7) array of
+# glyph codes and every glyph position and bounding box is computed at once from
+# the slot geometry of the plate variant. Codes index the planner alphabet,
+# letters first and numbers after them.
+#
+# Sampling is counter based, every draw is a hash of (seed, plateIdx, slot), so
+# a plate does not depend on the batch or the worker that planned it.
+import numpy as np
+
+# Slot kinds
+LETTER    = 0
+NUMBER    = 1
+ALPHANUM  = 2  # letter or number, decided by the lowest bit of the slot draw
+
+_GOLDEN   = np.uint64(0x9E3779B97F4A7C15)
+_MIX1     = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2     = np.uint64(0x94D049BB133111EB)
+
+def splitmix64(values):
+    # Finalizer of splitmix64 on a uint64 array, wraps around on overflow
+    values = np.asarray(values, dtype=np.uint64)
+    values = (values ^ (values >> np.uint64(30))) * _MIX1
+    values = (values ^ (values >> np.uint64(27))) * _MIX2
+    return values ^ (values >> np.uint64(31))
+
+def plateKeys(seed, indices):
+    seedKey = splitmix64(np.array([seed & 0xFFFFFFFFFFFFFFFF], dtype=np.uint64))
+    return splitmix64(seedKey + np.asarray(indices, dtype=np.uint64) * _GOLDEN)
+
+def slotDraws(keys, numSlots):
+    # (N, numSlots) independent uint64 draws
+    slots = np.arange(1, numSlots + 1, dtype=np.uint64) * _GOLDEN
+    return splitmix64(keys[:, np.newaxis] + slots[np.newaxis, :])
+
+def uniformIntegers(draws, high):
+    # Multiply-shift mapping of uint64 draws onto [0, high)
+    return ((draws >> np.uint64(32)) * np.uint64(high)) >> np.uint64(32)
+
+def feistel(values, keys, halfBits):
+    # Balanced Feistel network, a permutation of [0, 2 ** (2 * halfBits))
+    mask = np.uint64((1 << halfBits) - 1)
+    half = np.uint64(halfBits)
+    left, right = values >> half, values & mask
+    for key in keys:
+        left, right = right, left ^ (splitmix64(right ^ key) & mask)
+    return (left << half) | right
+
+def weightedIntegers(draws, weights):
+    # Inverse CDF mapping of uint64 draws onto [0, len(weights)), zero weights are never drawn
+    cdf      = np.cumsum(weights, dtype=np.float64)
+    uniforms = (draws >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53)) * cdf[-1]
+    return np.minimum(np.searchsorted(cdf, uniforms, side='right'), len(cdf) - 1)
+
+
+class PlatePlanner:
+    def __init__(self, letters, numbers, glyphSizes, slotKinds, lines, letterPadding, numberPadding, boxPadding):
+        # glyphSizes: (width, height) of every code
+        # lines:      (firstSlot, x, y) of every text line of the plate
+        self.alphabet      = list(letters) + list(numbers)
+        self.numLetters    = len(letters)
+        self.numNumbers    = len(numbers)
+        self.slotKinds     = np.asarray(slotKinds, dtype=np.int64)
+        self.numSlots      = len(self.slotKinds)
+        self.boxPadding    = boxPadding
+
+        glyphSizes         = np.asarray(glyphSizes, dtype=np.int64)
+        self.glyphWidths   = glyphSizes[:, 0]
+        self.glyphHeights  = glyphSizes[:, 1]
+        self.advances      = self.glyphWidths + np.where(np.arange(len(self.alphabet)) < self.numLetters,
+                                                         letterPadding, numberPadding)
+
+        # Mixed radix of the plate string space, the first slot is the most significant
+        self.slotRadix     = np.where(self.slotKinds == LETTER, self.numLetters,
+                                      np.where(self.slotKinds == NUMBER, self.numNumbers, self.numLetters + self.numNumbers))
+        self.slotPlace     = np.cumprod(self.slotRadix[::-1])[::-1] // self.slotRadix
+        self.spaceSize     = int(np.prod(self.slotRadix.astype(object)))
+
+        # Line start and first slot of the line, per slot
+        self.lineX         = np.zeros(self.numSlots, dtype=np.int64)
+        self.lineY         = np.zeros(self.numSlots, dtype=np.int64)
+        self.lineFirstSlot = np.zeros(self.numSlots, dtype=np.int64)
+        for firstSlot, x, y in lines:
+            self.lineX[firstSlot:]         = x
+            self.lineY[firstSlot:]         = y
+            self.lineFirstSlot[firstSlot:] = firstSlot
+
+    def sampleCodes(self, draws, weights=None):
+        # draws: (N, numSlots), the high bits pick the glyph. weights: per code, uniform when None
+        if weights is None:
+            letters = uniformIntegers(draws, self.numLetters).astype(np.int64)
+            numbers = uniformIntegers(draws, self.numNumbers).astype(np.int64) + self.numLetters
+        else:
+            letters = weightedIntegers(draws, weights[:self.numLetters]).astype(np.int64)
+            numbers = weightedIntegers(draws, weights[self.numLetters:]).astype(np.int64) + self.numLetters
+        coinFlips = (draws & np.uint64(1)).astype(bool)
+        isLetter  = np.where(self.slotKinds == ALPHANUM, coinFlips, self.slotKinds == LETTER)
+        return np.where(isLetter, letters, numbers)
+
+    def plan(self, indices, seed, weights=None):
+        indices = np.asarray(indices, dtype=np.int64)
+        draws   = slotDraws(plateKeys(seed, indices), self.numSlots)
+        return self.layout(indices, self.sampleCodes(draws, weights))
+
+    def deficitWeights(self, counts, target, numPlates):
+        # Sampling weights that bring counts back to the target distribution, letters and
+        # numbers are balanced separately as every slot draws from only one of them.
+        # Each code is weighted by how far it is from its target share once the next
+        # numPlates plates are drawn, alphanumeric slots count half for each group
+        counts        = np.asarray(counts, dtype=np.float64)
+        target        = np.asarray(target, dtype=np.float64)
+        alphanumDraws = 0.5 * np.count_nonzero(self.slotKinds == ALPHANUM)
+        weights       = np.zeros(len(self.alphabet))
+        groups        = ((slice(0, self.numLetters), np.count_nonzero(self.slotKinds == LETTER) + alphanumDraws),
+                         (slice(self.numLetters, None), np.count_nonzero(self.slotKinds == NUMBER) + alphanumDraws))
+        for group, drawsPerPlate in groups:
+            share          = target[group] / target[group].sum()
+            deficit        = share * (counts[group].sum() + drawsPerPlate * numPlates) - counts[group]
+            deficit        = np.maximum(deficit, 0) * (share > 0)
+            weights[group] = deficit if deficit.sum() > 0 else share
+        return weights
+
+    def layout(self, indices, codes):
+        # Glyphs of a line follow each other, x is the running sum of the advances
+        advances   = self.advances[codes]
+        offsets    = np.cumsum(advances, axis=1) - advances
+        xMins      = self.lineX + offsets - offsets[:, self.lineFirstSlot]
+        yMins      = np.broadcast_to(self.lineY, codes.shape)
+        return {
+            "indices": indices,
+            "codes":   codes,
+            "xMins":   xMins,
+            "yMins":   yMins,
+            "xMaxs":   xMins + self.glyphWidths[codes] + self.boxPadding,
+            "yMaxs":   yMins + self.glyphHeights[codes],
+        }
+
+    def decode(self, ranks):
+        # (N,) ranks in the plate string space to (N, numSlots) codes, letters or numbers
+        # slots only hold their own kind so only number slots are shifted
+        digits = (np.asarray(ranks, dtype=np.int64)[:, np.newaxis] // self.slotPlace) % self.slotRadix
+        return np.where(self.slotKinds == NUMBER, digits + self.numLetters, digits)
+
+    def encode(self, codes):
+        digits = np.where(self.slotKinds == NUMBER, codes - self.numLetters, codes)
+        return (digits * self.slotPlace).sum(axis=1)
+
+    def rankOf(self, plateString):
+        # Rank of a plate string such as "ABC1D23", None when the variant cannot produce it
+        if len(plateString) != self.numSlots:
+            return None
+        codes = []
+        for char, kind in zip(plateString.upper(), self.slotKinds.tolist()):
+            if char not in self.alphabet:
+                return None
+            code = self.alphabet.index(char)
+            if (kind == LETTER and code >= self.numLetters) or (kind == NUMBER and code < self.numLetters):
+                return None
+            codes.append(code)
+        return int(self.encode(np.array([codes]))[0])
+
+    def permute(self, positions, seed):
+        # Seeded shuffle of the plate string space, position -> rank. Cycle walking over a
+        # Feistel network on the next even power of two keeps it a permutation of [0, spaceSize)
+        positions = np.asarray(positions, dtype=np.int64)
+        if len(positions) and (positions.min() < 0 or positions.max() >= self.spaceSize):
+            raise ValueError("Only %d different plates exist" % self.spaceSize)
+        halfBits = max(1, (self.spaceSize - 1).bit_length() + 1) // 2
+        keys     = splitmix64(plateKeys(seed, [0]) + np.arange(1, 5, dtype=np.uint64) * _GOLDEN)
+        ranks    = feistel(positions.astype(np.uint64), keys, halfBits)
+        outside  = ranks >= np.uint64(self.spaceSize)
+        while outside.any():
+            ranks[outside] = feistel(ranks[outside], keys, halfBits)
+            outside        = ranks >= np.uint64(self.spaceSize)
+        return ranks.astype(np.int64)
+
+    def planUnique(self, indices, seed):
+        # Plate idx gets the string at position idx of the shuffled space, so plates never repeat
+        indices = np.asarray(indices, dtype=np.int64)
+        return self.layout(indices, self.decode(self.permute(indices, seed)))
+
+    def chars(self, codes):
+        return [self.alphabet[code] for code in codes]
+
+    def counts(self, plan):
+        # Occurrences of every code in the plan
+        return np.bincount(plan["codes"].ravel(), minlength=len(self.alphabet))
+
+
+class PlateIndex:
+    # Bitmap over the plate string space, one bit per rank
+    def __init__(self, spaceSize):
+        self.spaceSize = spaceSize
+        self.bits      = np.zeros((spaceSize + 7) // 8, dtype=np.uint8)
+        self.count     = 0
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, rank):
+        return bool(self.contains(np.array([rank]))[0])
+
+    def contains(self, ranks):
+        ranks = np.asarray(ranks, dtype=np.int64)
+        return ((self.bits[ranks >> 3] >> (ranks & 7).astype(np.uint8)) & 1).astype(bool)
+
+    def add(self, ranks):
+        ranks = np.unique(np.asarray(ranks, dtype=np.int64))
+        ranks = ranks[~self.contains(ranks)]
+        np.bitwise_or.at(self.bits, ranks >> 3, (1 << (ranks & 7)).astype(np.uint8))
+        self.count += len(ranks)
@@ -0,0 +1,54 @@
+# Segmentation cache of the real plate extractor: the boxes of every image and
+# whether it was accepted, kept in a JSON file between runs. An entry is reused
+# while its file keeps the same size and mtime, the whole cache is dropped when
+# the extractor config changes.
+import os
+import json
+import hashlib
+
+class SegmentationCache:
+    def __init__(self, cacheFile, configs):
+        self.cacheFile = cacheFile
+        self.configKey = self.buildConfigKey(configs)
+        self.entries   = {}
+        self.hits      = 0
+        self.misses    = 0
+
+        if os.path.isfile(cacheFile):
+            with open(cacheFile) as file:
+                cache = json.load(file)
+            if cache.get("configKey") == self.configKey:
+                self.entries = cache.get("entries", {})
+
+    @staticmethod
+    def buildConfigKey(configs):
+        return hashlib.sha1(json.dumps(configs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def fileKey(image):
+        stat = os.stat(image)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def get(self, image, fileKey):
+        # Returns {"boxes": [...], "accepted": bool}, None when the image must be segmented again
+        entry = self.entries.get(image)
+        if entry is None or entry["file"] != fileKey:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, image, fileKey, boxes, accepted):
+        self.entries[image] = {"file": fileKey, "boxes": [list(box) for box in boxes], "accepted": accepted}
+
+    def prune(self, images):
+        # Forgets the images that are gone
+        images       = set(images)
+        self.entries = {image: entry for image, entry in self.entries.items() if image in images}
+
+    def save(self):
+        # Written to a temporary file first, a crash never leaves a partial cache
+        tmpFile = self.cacheFile + ".tmp"
+        with open(tmpFile, "w") as file:
+            json.dump({"configKey": self.configKey, "entries": self.entries}, file)
+        os.replace(tmpFile, self.cacheFile)
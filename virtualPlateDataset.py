@@ -0,0 +1,47 @@
+# Virtual dataset: plate i is rendered on demand from (seed, i), so a dataset of
+# any size takes no storage and any sample can be reproduced exactly. The plate
+# string, layout, augmentation and background all come from per-plate seeds,
+# dataset[i] is the plate i of PlateGenerator.iterPlates(len, seed=seed).
+import random
+
+class VirtualPlateDataset:
+    def __init__(self, generator, numOfPlates, seed=None, resize=True, unique=False, indices=None):
+        # unique: plate i gets the string at position i of the shuffled plate space, strings never repeat
+        if generator.balanceCharacters and not unique:
+            raise ValueError("Balanced plates depend on the plates drawn before them, they cannot be addressed by index")
+        if unique and numOfPlates > generator.planner.spaceSize:
+            raise ValueError("Only %d different plates exist" % generator.planner.spaceSize)
+        self.generator   = generator
+        self.numOfPlates = numOfPlates
+        self.seed        = seed if seed is not None else random.randrange(2 ** 32)
+        self.resize      = resize
+        self.unique      = unique
+        self.indices     = indices if indices is not None else range(numOfPlates)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, item):
+        # dataset[i] renders a plate, dataset[start:stop:step] is a view rendering nothing
+        if isinstance(item, slice):
+            return VirtualPlateDataset(self.generator, self.numOfPlates, seed=self.seed, resize=self.resize,
+                                       unique=self.unique, indices=self.indices[item])
+        return self.render(self.indices[item])
+
+    def __iter__(self):
+        for idx in self.indices:
+            yield self.render(idx)
+
+    def plan(self, idx):
+        # Planned by the planner itself, reading plates leaves the generator statistics alone
+        planner = self.generator.planner
+        return planner.planUnique([idx], self.seed) if self.unique else planner.plan([idx], self.seed)
+
+    def render(self, idx):
+        batch = {"indices": [idx], "randoms": [self.generator.plateRandom(idx, self.seed)], "plan": self.plan(idx)}
+        return self.generator.renderBatch(batch, resize=self.resize)[0]
+
+    def plateString(self, item):
+        # Characters of a plate, planned without rendering it
+        plan = self.plan(self.indices[item])
+        return "".join(self.generator.planner.chars(plan["codes"][0]))